@@ -0,0 +1,47 @@
+import argparse
+import asyncio
+
+from common.batch import load_questions, run_batch
+
+###
+# Runs a file of questions (JSONL with a "question" field per line, or CSV with a "question" column)
+# through the bot and appends one JSON line per answer to the output file.
+# Re-running with the same output file only answers the questions that are not in it yet.
+#   python batch_questions.py questions.jsonl --output answers.jsonl --mode search --concurrency 8
+###
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a batch of questions")
+    parser.add_argument("questions", help="JSONL or CSV file with the questions")
+    parser.add_argument("--output", default="answers.jsonl", help="JSONL file the answers are appended to")
+    parser.add_argument("--mode", choices=["search", "agent"], default="search",
+                        help="search: Bing search then one LLM call (using_bing_search.py), agent: Bing agent (BingSearchTool)")
+    parser.add_argument("--concurrency", type=int, default=8, help="questions in flight at once")
+    parser.add_argument("--rate", type=float, default=2.0, help="starting questions per second, adapted on throttling")
+    args = parser.parse_args()
+
+    # Imported here, after parsing the arguments, because they load langchain and the credentials
+    from using_bing_search import MODEL, COMPLETION_TOKENS, aanswer_question
+    from common import bing
+
+    # Failures are raised rather than answered, so the runner records and retries them (and slows down on throttling)
+    if args.mode == "search":
+        async def answer(question: str) -> dict:
+            return await aanswer_question(question, raise_errors=True)
+    else:
+        from common.llm_pool import build_chat_model
+        from common.utils import BingSearchTool
+
+        tool = BingSearchTool(llm=build_chat_model(MODEL, max_tokens=COMPLETION_TOKENS), raise_errors=True)
+
+        async def answer(question: str) -> dict:
+            return {"answer": await tool.arun(question)}
+
+    async def main():
+        try:
+            return await run_batch(load_questions(args.questions), answer, args.output,
+                                   concurrency=args.concurrency, rate=args.rate)
+        finally:
+            await bing.close_session()
+
+    print(asyncio.run(main()))
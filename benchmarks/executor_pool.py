@@ -0,0 +1,41 @@
+###
+# Measures the per-call setup cost BingSearchTool used to pay (a new agent executor per call)
+# against checking an executor out of the shared pool. No network calls are made.
+# Run from the repository root: python -m benchmarks.executor_pool
+###
+import os
+import time
+
+from langchain.chat_models import AzureChatOpenAI
+
+os.environ.setdefault("BING_SUBSCRIPTION_KEY", "benchmark")
+os.environ.setdefault("BING_SEARCH_URL", "http://127.0.0.1:9/")
+
+from common.pool import EXECUTOR_POOL
+from common.utils import BingSearchTool
+
+ITERATIONS = int(os.environ.get("BENCH_ITERATIONS", 500))
+
+
+def timed(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def checkout(tool: BingSearchTool) -> None:
+    with tool._executor():
+        pass
+
+
+if __name__ == "__main__":
+    llm = AzureChatOpenAI(deployment_name="benchmark", openai_api_key="benchmark",
+                          openai_api_base="http://127.0.0.1:9/", openai_api_version="2023-07-01-preview")
+    tool = BingSearchTool(llm=llm)
+
+    rebuild = timed(tool._build_executor, ITERATIONS)
+    pooled = timed(lambda: checkout(tool), ITERATIONS)
+    print(f"initialize_agent per call: {rebuild:9.1f} us")
+    print(f"pooled executor per call:  {pooled:9.1f} us")
+    print(f"speedup: {rebuild / pooled:.0f}x  pool: {EXECUTOR_POOL.stats()}")
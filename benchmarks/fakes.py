@@ -0,0 +1,176 @@
+###
+# Local stand-ins for the paid services, used by the benchmarks:
+# - FakeBingServer replays recorded Bing v7 responses (fixtures/bing_responses.json) over HTTP,
+#   so the real client, its connection pools, retries and caches are exercised
+# - FakeChatModel is a chat model that answers like gpt-35-turbo would for our prompts, with
+#   configurable latency, token streaming and a share of outputs the agent parser rejects
+###
+import asyncio
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+
+from common.cache import normalize_query
+from common.context import count_tokens
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+ANSWER = ("There is an initial non-refundable application fee of **£150** for an officer to assess whether "
+          "a vehicle access will be allowed, and the fee must be sent with the application form. "
+          "Anything else I can help you with?")
+
+TOOL_NAMES_RE = re.compile(r"should be one of \[([^\]]+)\]")
+TOKEN_RE = re.compile(r"\s*\S+")
+
+# Token usage of the request being measured; the harness sets a fresh dict per request
+USAGE: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar("benchmark_usage", default=None)
+
+
+def new_usage() -> Dict[str, int]:
+    usage = {"llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    USAGE.set(usage)
+    return usage
+
+
+class FakeBingServer:
+    """Bing v7 endpoint answering from recorded responses, matched on the normalized query.
+
+    Queries without a recording get the response whose key shares the most words with them.
+    """
+
+    def __init__(self, responses_path: str = os.path.join(FIXTURES, "bing_responses.json"), latency: float = 0.05):
+        with open(responses_path, encoding="utf-8") as f:
+            self.responses = json.load(f)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-bing", daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/v7.0/search"
+
+    def start(self) -> "FakeBingServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def response_for(self, query: str) -> Dict:
+        text, _ = normalize_query(query)
+        words = set(text.split())
+        best = max(self.responses, key=lambda key: len(words.intersection(key.split())))
+        return self.responses[best]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+                body = json.dumps(fake.response_for(query)).encode("utf-8")
+                time.sleep(fake.latency)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model replying to the pipelines' prompts without a network call.
+
+    Agent prompts get a search action on the first step and a final answer once there is an
+    observation; a `parse_error_rate` share of final steps is malformed instead, two thirds of them
+    recoverable locally (a bare thought and answer, or the answer alone over several paragraphs) and
+    a third needing the LLM reformat fallback. Any other prompt gets a plain
+    answer. `latency` is the time to the first token and `token_latency` the time between tokens.
+    """
+
+    latency: float = 0.3
+    token_latency: float = 0.01
+    streaming: bool = False
+    parse_error_rate: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self, prompt: str) -> str:
+        tools = TOOL_NAMES_RE.search(prompt)
+        if not tools:
+            return ANSWER
+        tool = tools.group(1).split(",")[0].strip()
+        scratchpad = prompt.rsplit("Question:", 1)[-1]
+        if "Observation:" not in scratchpad:
+            question = scratchpad.split("\n", 1)[0].strip()
+            return f" I should search the council website.\nAction: {tool}\nAction Input: {question}"
+        if random.random() < self.parse_error_rate:
+            kind = random.randrange(3)
+            if kind == 0:
+                return " I now know the answer. " + ANSWER
+            if kind == 1:
+                return ANSWER.replace(" Anything else", "\n\nAnything else")
+            return f" I now know the answer.\nAction: {tool}\n{ANSWER}"
+        return " I now know the final answer.\nFinal Answer: " + ANSWER
+
+    def _result(self, messages: List[BaseMessage], reply: str, tokens: int) -> ChatResult:
+        prompt_tokens = sum(count_tokens(m.content) for m in messages)
+        self.calls += 1
+        usage = USAGE.get()
+        if usage is not None:
+            usage["llm_calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += tokens
+        token_usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens}
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=reply))],
+                          llm_output={"token_usage": token_usage, "model_name": self._llm_type})
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        reply = self._reply("\n".join(m.content for m in messages))
+        tokens = TOKEN_RE.findall(reply)
+        time.sleep(self.latency)
+        for token in tokens:
+            if self.streaming and run_manager:
+                run_manager.on_llm_new_token(token)
+            if self.token_latency:
+                time.sleep(self.token_latency)
+        return self._result(messages, reply, len(tokens))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        reply = self._reply("\n".join(m.content for m in messages))
+        tokens = TOKEN_RE.findall(reply)
+        await asyncio.sleep(self.latency)
+        for token in tokens:
+            if self.streaming and run_manager:
+                await run_manager.on_llm_new_token(token)
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+        return self._result(messages, reply, len(tokens))
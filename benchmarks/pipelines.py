@@ -0,0 +1,240 @@
+###
+# Offline throughput/latency benchmark of the answering pipelines, with no paid services:
+# Bing is replaced by a local server replaying recorded responses and Azure OpenAI by a fake
+# chat model (see benchmarks/fakes.py). Reports p50/p95/p99 latency, QPS, LLM calls and tokens
+# per request, and the memory allocated per request (measured in a separate tracemalloc pass so
+# it doesn't skew the timings).
+#
+# Run from the repository root, e.g.:
+#   python -m benchmarks.pipelines --pipelines search agent tool --concurrency 1 8 --requests 40
+#   python -m benchmarks.pipelines --mode sync --llm-latency 0.5 --parse-error-rate 0.2
+#   python -m benchmarks.pipelines --save baseline.json
+#   python -m benchmarks.pipelines --compare baseline.json --tolerance 0.2   # exits 1 on regression
+###
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+# The scripts configure Azure OpenAI from the environment when imported; point everything at
+# local addresses so nothing can reach a paid endpoint
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1:9/")
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2023-07-01-preview")
+os.environ.setdefault("BING_SUBSCRIPTION_KEY", "benchmark")
+# The answer cache needs an embeddings deployment and page fetching needs the internet
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+os.environ.setdefault("FETCH_PAGES", "false")
+os.environ.setdefault("SEARCH_CACHE_PATH", "")
+
+from langchain.agents import AgentType, initialize_agent
+
+from benchmarks.fakes import FIXTURES, FakeBingServer, FakeChatModel, new_usage
+from common import bing
+from common.batch import load_questions
+from common.cache import get_search_cache
+from common.prompts import BING_PROMPT_PREFIX
+from common.utils import BingSearchTool, arun_agent, parser_recovery_stats, run_agent
+from using_bing_search import MyBingSearch, aanswer_question, answer_question
+
+PIPELINES = ("search", "agent", "tool")
+
+
+def build_pipelines(llm: FakeChatModel) -> Dict[str, Dict[str, Callable]]:
+    """Sync and async callables answering one question with each pipeline"""
+    agent = initialize_agent(llm=llm, tools=[MyBingSearch()], agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+                             agent_kwargs={"prefix": BING_PROMPT_PREFIX})
+    tool = BingSearchTool(llm=llm)
+    return {
+        "search": {"sync": lambda q: answer_question(q, llm=llm)["answer"],
+                   "async": lambda q: _answer(aanswer_question(q, llm=llm))},
+        "agent": {"sync": lambda q: run_agent(q, agent), "async": lambda q: arun_agent(q, agent)},
+        "tool": {"sync": tool.run, "async": tool.arun},
+    }
+
+
+async def _answer(result) -> str:
+    return (await result)["answer"]
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def _measure_sync(fn: Callable, question: str) -> Dict:
+    usage = new_usage()
+    start = time.perf_counter()
+    try:
+        fn(question)
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return {"latency": time.perf_counter() - start, "error": error, **usage}
+
+
+async def _measure_async(fn: Callable, question: str, semaphore: asyncio.Semaphore) -> Dict:
+    async with semaphore:
+        usage = new_usage()
+        start = time.perf_counter()
+        try:
+            await fn(question)
+            error = None
+        except Exception as e:
+            error = repr(e)
+        return {"latency": time.perf_counter() - start, "error": error, **usage}
+
+
+async def run_load(fn: Callable, mode: str, questions: List[str], concurrency: int) -> List[Dict]:
+    if mode == "async":
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(_measure_async(fn, q, semaphore) for q in questions))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: list(pool.map(lambda q: _measure_sync(fn, q), questions)))
+
+
+async def measure_allocations(fn: Callable, mode: str, questions: List[str]) -> Dict:
+    """Peak and retained traced memory per request, one request at a time"""
+    tracemalloc.start()
+    peaks, retained = [], 0
+    try:
+        for question in questions:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            if mode == "async":
+                await _measure_async(fn, question, asyncio.Semaphore(1))
+            else:
+                _measure_sync(fn, question)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained += current - before
+    finally:
+        tracemalloc.stop()
+    return {"alloc_peak_kib": sum(peaks) / len(peaks) / 1024, "alloc_retained_kib": retained / len(questions) / 1024}
+
+
+def summarize(pipeline: str, mode: str, concurrency: int, samples: List[Dict], elapsed: float) -> Dict:
+    ok = [s for s in samples if not s["error"]]
+    latencies = [s["latency"] * 1000 for s in ok] or [math.nan]
+    return {
+        "pipeline": pipeline, "mode": mode, "concurrency": concurrency,
+        "requests": len(samples), "errors": len(samples) - len(ok),
+        "qps": len(ok) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50), "p95_ms": percentile(latencies, 95), "p99_ms": percentile(latencies, 99),
+        "llm_calls": sum(s["llm_calls"] for s in samples) / len(samples),
+        "prompt_tokens": sum(s["prompt_tokens"] for s in samples) / len(samples),
+        "completion_tokens": sum(s["completion_tokens"] for s in samples) / len(samples),
+    }
+
+
+COLUMNS = [("pipeline", "{:<8}"), ("mode", "{:<6}"), ("concurrency", "{:>4}"), ("requests", "{:>5}"), ("errors", "{:>4}"),
+           ("qps", "{:>7.2f}"), ("p50_ms", "{:>8.0f}"), ("p95_ms", "{:>8.0f}"), ("p99_ms", "{:>8.0f}"),
+           ("llm_calls", "{:>5.1f}"), ("prompt_tokens", "{:>7.0f}"), ("completion_tokens", "{:>6.0f}"),
+           ("alloc_peak_kib", "{:>9.0f}"), ("alloc_retained_kib", "{:>9.1f}")]
+HEADERS = ["pipeline", "mode", "conc", "reqs", "errs", "qps", "p50 ms", "p95 ms", "p99 ms",
+           "calls", "prompt", "compl", "peak KiB", "kept KiB"]
+
+
+def print_row(row: Dict) -> None:
+    print("  ".join(fmt.format(row[key]) if key in row else " " * len(fmt.format(0)) for key, fmt in COLUMNS), flush=True)
+
+
+def compare(rows: List[Dict], baseline_path: str, tolerance: float) -> List[str]:
+    """Runs slower (p95) or with lower throughput than the baseline by more than `tolerance`"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["pipeline"], r["mode"], r["concurrency"]): r for r in json.load(f)}
+    regressions = []
+    for row in rows:
+        base = baseline.get((row["pipeline"], row["mode"], row["concurrency"]))
+        if base is None:
+            continue
+        if row["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{row['pipeline']}/{row['mode']}/c{row['concurrency']}: p95 {base['p95_ms']:.0f} -> {row['p95_ms']:.0f} ms")
+        if row["qps"] < base["qps"] * (1 - tolerance):
+            regressions.append(f"{row['pipeline']}/{row['mode']}/c{row['concurrency']}: qps {base['qps']:.2f} -> {row['qps']:.2f}")
+    return regressions
+
+
+async def main(args) -> int:
+    random.seed(args.seed)
+    server = FakeBingServer(args.bing_responses, latency=args.bing_latency).start()
+    os.environ["BING_SEARCH_URL"] = server.url
+    llm = FakeChatModel(latency=args.llm_latency, token_latency=args.token_latency,
+                        streaming=args.streaming, parse_error_rate=args.parse_error_rate)
+    pipelines = build_pipelines(llm)
+    questions = [q["question"] for q in load_questions(args.questions)]
+    workload = [questions[i % len(questions)] for i in range(args.requests)]
+    cache = get_search_cache()
+
+    print(" ".join(f"{h:>{len(fmt.format(0))}}" if i > 1 else f"{h:<{len(fmt.format(0))}}"
+                   for i, (h, (_, fmt)) in enumerate(zip(HEADERS, COLUMNS))))
+    rows = []
+    try:
+        for pipeline in args.pipelines:
+            fn = pipelines[pipeline][args.mode]
+            for concurrency in args.concurrency:
+                if not args.search_cache:
+                    cache.clear()
+                await run_load(fn, args.mode, questions[:2], 1)  # warm up pools and lazy imports
+                if not args.search_cache:
+                    cache.clear()
+                start = time.perf_counter()
+                samples = await run_load(fn, args.mode, workload, concurrency)
+                row = summarize(pipeline, args.mode, concurrency, samples, time.perf_counter() - start)
+                if args.alloc_requests:
+                    if not args.search_cache:
+                        cache.clear()
+                    row.update(await measure_allocations(fn, args.mode, workload[:args.alloc_requests]))
+                rows.append(row)
+                print_row(row)
+                errors = [s["error"] for s in samples if s["error"]]
+                if errors:
+                    print(f"    first error: {errors[0]}", flush=True)
+    finally:
+        await bing.close_session()
+        server.stop()
+
+    print(f"bing requests: {server.requests}  parser recovery: {parser_recovery_stats()}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+    if args.compare:
+        regressions = compare(rows, args.compare, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the answering pipelines against local fakes of Bing and Azure OpenAI")
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=list(PIPELINES),
+                        help="search: using_bing_search.answer_question, agent: run_agent, tool: BingSearchTool")
+    parser.add_argument("--mode", choices=("async", "sync"), default="async", help="async entry points, or the sync ones on a thread pool")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--requests", type=int, default=40, help="requests per run")
+    parser.add_argument("--questions", default=os.path.join(FIXTURES, "questions.jsonl"))
+    parser.add_argument("--bing-responses", default=os.path.join(FIXTURES, "bing_responses.json"))
+    parser.add_argument("--bing-latency", type=float, default=0.05, help="seconds the fake Bing server takes per request")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds to the first token of every LLM call")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds between generated tokens")
+    parser.add_argument("--streaming", action="store_true", help="emit tokens through the callbacks as they are generated")
+    parser.add_argument("--parse-error-rate", type=float, default=0.0, help="share of final agent steps that don't parse")
+    parser.add_argument("--search-cache", action="store_true", help="keep the search cache between requests (cleared by default)")
+    parser.add_argument("--alloc-requests", type=int, default=10, help="requests traced with tracemalloc after each run, 0 to skip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results as JSON, to use as a --compare baseline")
+    parser.add_argument("--compare", help="baseline JSON from --save; exit 1 if p95 or QPS regress by more than --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,99 @@
+###
+# Fires N concurrent copies of the same question (varying only in case and spacing) at each
+# pipeline and checks they were answered by exactly one Bing search and one LLM run, against the
+# local fakes in benchmarks/fakes.py. Exits with an error if any request was not coalesced.
+# Run from the repository root: python -m benchmarks.singleflight [--requests 50]
+###
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("BING_SUBSCRIPTION_KEY", "benchmark")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "false")
+os.environ.setdefault("FETCH_PAGES", "false")
+os.environ.setdefault("SEARCH_CACHE_PATH", "")
+
+from langchain.agents import AgentType, initialize_agent
+
+from benchmarks.fakes import FakeBingServer, FakeChatModel
+from common import bing
+from common.cache import get_search_cache
+from common.prompts import BING_PROMPT_PREFIX
+from common.singleflight import COALESCE_REQUESTS, SINGLE_FLIGHT
+from common.utils import BingSearchTool, arun_agent, astream_agent, run_agent, stream_agent
+from using_bing_search import MyBingSearch, aanswer_question, answer_question, astream_answer, stream_answer
+
+QUESTION = "How much does a dropped kerb cost?"
+
+
+def variants(n: int):
+    forms = [QUESTION, QUESTION.lower(), "  " + QUESTION.upper(), QUESTION.replace(" ", "  ")]
+    return [forms[i % len(forms)] for i in range(n)]
+
+
+async def _collect(stream) -> list:
+    return [item async for item in stream]
+
+
+def scenarios(llm: FakeChatModel):
+    agent = initialize_agent(llm=llm, tools=[MyBingSearch()], agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+                             agent_kwargs={"prefix": BING_PROMPT_PREFIX})
+    tool = BingSearchTool(llm=llm)
+    # name: (callable, whether it is async, LLM calls one run makes)
+    return {
+        "answer_question": (lambda q: answer_question(q, llm=llm)["answer"], False, 1),
+        "aanswer_question": (lambda q: _answer(aanswer_question(q, llm=llm)), True, 1),
+        "stream_answer": (lambda q: list(stream_answer(q, llm=llm))[-1]["answer"], False, 1),
+        "astream_answer": (lambda q: _last(astream_answer(q, llm=llm)), True, 1),
+        "run_agent": (lambda q: run_agent(q, agent), False, 2),
+        "arun_agent": (lambda q: arun_agent(q, agent), True, 2),
+        "stream_agent": (lambda q: list(stream_agent(q, agent))[-1]["answer"], False, 2),
+        "astream_agent": (lambda q: _last(astream_agent(q, agent)), True, 2),
+        "BingSearchTool.run": (tool.run, False, 2),
+        "BingSearchTool.arun": (tool.arun, True, 2),
+    }
+
+
+async def _answer(result) -> str:
+    return (await result)["answer"]
+
+
+async def _last(stream) -> str:
+    return (await _collect(stream))[-1]["answer"]
+
+
+async def main(requests: int) -> int:
+    server = FakeBingServer(latency=0.05).start()
+    os.environ["BING_SEARCH_URL"] = server.url
+    llm = FakeChatModel(latency=0.2, token_latency=0.002, streaming=True)
+    failures = 0
+    print(f"{requests} concurrent identical requests per pipeline (COALESCE_REQUESTS={COALESCE_REQUESTS})")
+    try:
+        for name, (fn, is_async, llm_calls) in scenarios(llm).items():
+            get_search_cache().clear()
+            bing_before, llm_before = server.requests, llm.calls
+            start = time.perf_counter()
+            if is_async:
+                answers = await asyncio.gather(*(fn(q) for q in variants(requests)))
+            else:
+                with ThreadPoolExecutor(max_workers=requests) as pool:
+                    answers = await asyncio.get_running_loop().run_in_executor(None, lambda: list(pool.map(fn, variants(requests))))
+            elapsed = time.perf_counter() - start
+            searches, calls = server.requests - bing_before, llm.calls - llm_before
+            ok = searches == 1 and calls == llm_calls and len(set(answers)) == 1
+            failures += not ok
+            print(f"{name:<20} {elapsed * 1000:7.0f} ms  bing searches: {searches:3}  llm calls: {calls:3}  {'ok' if ok else 'NOT COALESCED'}")
+    finally:
+        await bing.close_session()
+        server.stop()
+    print(SINGLE_FLIGHT.stats())
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that concurrent identical questions share one search and LLM run")
+    parser.add_argument("--requests", type=int, default=50)
+    sys.exit(asyncio.run(main(parser.parse_args().requests)))
@@ -0,0 +1,103 @@
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+def results_fingerprint(results: List[Dict]) -> str:
+    """Stable hash of a search result set, used to tell when the sources behind an answer have changed"""
+    digest = hashlib.sha1()
+    for result in sorted(results, key=lambda r: r.get("url", r.get("link", ""))):
+        digest.update(str(result.get("url", result.get("link", ""))).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(str(result.get("snippet", "")).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SemanticAnswerCache:
+    """Answer cache that matches questions by embedding similarity.
+
+    Embeddings are kept L2-normalized in a fixed size matrix so a lookup is a single
+    matrix-vector product. When the cache is full the least recently used entry is replaced.
+    An entry only matches if the search results it was built from have the same fingerprint;
+    a similar question whose results have changed invalidates the stale entry.
+    """
+
+    def __init__(self, embeddings: Embeddings, threshold: float = 0.95, maxsize: int = 1024, ttl: float = 24 * 3600):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._vectors: Optional[np.ndarray] = None
+        self._entries: List[Optional[Dict]] = [None] * maxsize
+        self._last_used = np.zeros(maxsize)
+        self._lock = threading.Lock()
+
+    def embed(self, question: str) -> np.ndarray:
+        """Normalized embedding of a question; pass it to lookup and add to embed the question only once"""
+        vector = np.asarray(self.embeddings.embed_query(question.strip().lower()), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    async def aembed(self, question: str) -> np.ndarray:
+        vector = np.asarray(await self.embeddings.aembed_query(question.strip().lower()), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _best_match(self, vector: np.ndarray):
+        if self._vectors is None:
+            return None, 0.0
+        scores = self._vectors @ vector
+        slot = int(np.argmax(scores))
+        return slot, float(scores[slot])
+
+    def lookup(self, question: str, fingerprint: str, vector: Optional[np.ndarray] = None) -> Optional[Dict]:
+        """Return the cached {'answer', 'sources'} for a similar question, or None"""
+        return self._lookup(self.embed(question) if vector is None else vector, fingerprint)
+
+    async def alookup(self, question: str, fingerprint: str, vector: Optional[np.ndarray] = None) -> Optional[Dict]:
+        return self._lookup(await self.aembed(question) if vector is None else vector, fingerprint)
+
+    def _lookup(self, vector: np.ndarray, fingerprint: str) -> Optional[Dict]:
+        with self._lock:
+            slot, score = self._best_match(vector)
+            entry = self._entries[slot] if slot is not None else None
+            if entry is not None and score >= self.threshold:
+                if entry["fingerprint"] == fingerprint and entry["expires"] > time.time():
+                    self._last_used[slot] = time.time()
+                    self.hits += 1
+                    return {"answer": entry["answer"], "sources": entry["sources"], "score": score}
+                self._evict(slot)
+            self.misses += 1
+            return None
+
+    def add(self, question: str, fingerprint: str, answer: str, sources: List[str], vector: Optional[np.ndarray] = None) -> None:
+        self._add(self.embed(question) if vector is None else vector, question, fingerprint, answer, sources)
+
+    async def aadd(self, question: str, fingerprint: str, answer: str, sources: List[str],
+                   vector: Optional[np.ndarray] = None) -> None:
+        self._add(await self.aembed(question) if vector is None else vector, question, fingerprint, answer, sources)
+
+    def _add(self, vector: np.ndarray, question: str, fingerprint: str, answer: str, sources: List[str]) -> None:
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+            slot, score = self._best_match(vector)
+            if self._entries[slot] is None or score < self.threshold:
+                slot = int(np.argmin(self._last_used))
+            self._vectors[slot] = vector
+            self._entries[slot] = {"question": question, "fingerprint": fingerprint, "answer": answer,
+                                   "sources": sources, "expires": time.time() + self.ttl}
+            self._last_used[slot] = time.time()
+
+    def _evict(self, slot: int) -> None:
+        self._vectors[slot] = 0
+        self._entries[slot] = None
+        self._last_used[slot] = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": sum(e is not None for e in self._entries)}
@@ -0,0 +1,121 @@
+import asyncio
+import csv
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+import openai
+
+try:
+    from .bing import BingSearchError, RateLimiter
+except Exception as e:
+    print(e)
+    from bing import BingSearchError, RateLimiter
+
+
+def load_questions(path: str) -> List[Dict]:
+    """Read questions from a JSONL file ({"id", "question"} per line) or a CSV file with a `question` column.
+
+    Questions without an id are numbered by their position in the file.
+    """
+    questions = []
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            rows: Iterable[Dict] = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for i, row in enumerate(rows):
+            question = row.get("question") or row.get("body") or row.get("title")
+            if question:
+                questions.append({"id": str(row.get("id") or row.get("request_id") or i), "question": question})
+    return questions
+
+
+def completed_ids(output_path: str) -> set:
+    """Ids already written to the output file, so an interrupted run can resume where it stopped"""
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # partial last line from a crash
+            if "error" not in record:
+                done.add(record["id"])
+    return done
+
+
+def is_rate_limited(error: Exception) -> bool:
+    if isinstance(error, BingSearchError):
+        return error.status == 429
+    # Includes the LLM pool's NoDeploymentAvailable, raised when every deployment is throttled or failing
+    return isinstance(error, openai.error.RateLimitError)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Rate limiter that backs off when upstream throttles and creeps back up while requests succeed (AIMD)"""
+
+    def __init__(self, rate: float, min_rate: float = 0.2, max_rate: Optional[float] = None):
+        super().__init__(rate)
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 4
+
+    def _set_rate(self, rate: float) -> None:
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.interval = 1.0 / self.rate
+
+    def throttled(self) -> None:
+        with self._lock:
+            self._set_rate(self.rate / 2)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self._set_rate(self.rate + 0.1)
+
+
+async def run_batch(questions: List[Dict], answer: Callable[[str], Awaitable[Dict]], output_path: str,
+                    concurrency: int = 8, rate: float = 2.0, max_attempts: int = 5) -> Dict[str, int]:
+    """Answer every question with at most `concurrency` in flight, appending one JSON line per result.
+
+    Each line is flushed as soon as its question finishes, and questions already in the output file
+    are skipped, so a crash mid-run loses nothing. Throttled questions are retried at a lower rate.
+    Failures, including a missing answer, are written with an `error` and answered again on the next run.
+    """
+    done = completed_ids(output_path)
+    pending = [q for q in questions if q["id"] not in done]
+    limiter = AdaptiveRateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {"skipped": len(questions) - len(pending), "answered": 0, "failed": 0}
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        async def worker(item: Dict) -> None:
+            async with semaphore:
+                record = {"id": item["id"], "question": item["question"]}
+                for attempt in range(max_attempts):
+                    await limiter.aacquire()
+                    start = time.perf_counter()
+                    try:
+                        result = await answer(item["question"])
+                        if result.get("answer") is None:
+                            raise ValueError("no answer was returned")
+                        limiter.succeeded()
+                        record.update(result)
+                        record.pop("error", None)
+                        break
+                    except Exception as e:
+                        record["error"] = f"{type(e).__name__}: {e}"
+                        if not is_rate_limited(e):
+                            break
+                        limiter.throttled()
+                    finally:
+                        record["latency"] = round(time.perf_counter() - start, 3)
+                stats["failed" if "error" in record else "answered"] += 1
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+
+        await asyncio.gather(*(worker(item) for item in pending))
+    return stats
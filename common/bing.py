@@ -0,0 +1,212 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class BingSearchError(Exception):
+    """Raised when a Bing search fails after all retries; `status` is the last HTTP status, if any"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimiter:
+    """Token bucket shared by sync and async callers.
+
+    Each call reserves the next free slot under a lock and then waits for it outside the lock,
+    so threads and coroutines queue fairly without holding anything while they sleep.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.burst = max(1, burst)
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            # Allow up to `burst` requests to go out back to back after an idle period
+            self._next = max(self._next, now - self.interval * (self.burst - 1))
+            wait = self._next - now
+            self._next += self.interval
+            return max(0.0, wait)
+
+    def acquire(self) -> None:
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self) -> None:
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class BingSearchClient:
+    """Bing v7 client shared by every search entry point.
+
+    Keeps a pooled keep-alive requests.Session for sync callers and an aiohttp session per event
+    loop for async callers. Both retry 429/5xx responses with jittered exponential backoff (or the
+    server's Retry-After) and draw from the same per-second request budget.
+    """
+
+    def __init__(self, subscription_key: Optional[str] = None, endpoint: Optional[str] = None,
+                 timeout: float = 10.0, max_retries: int = 3, backoff: float = 0.5, max_backoff: float = 8.0,
+                 rate_limit: float = 0, pool_size: int = 20):
+        self.subscription_key = subscription_key or os.environ["BING_SUBSCRIPTION_KEY"]
+        self.endpoint = endpoint or os.environ["BING_SEARCH_URL"]
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.limiter = RateLimiter(rate_limit, burst=max(1, int(rate_limit)))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Ocp-Apim-Subscription-Key": self.subscription_key})
+
+        self._asession: Optional[aiohttp.ClientSession] = None
+        self._asession_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _delay(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after:
+            try:
+                return min(self.max_backoff, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def search(self, params: Dict) -> Dict:
+        """Call the search endpoint and return the decoded JSON"""
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise BingSearchError(str(e)) from e
+                time.sleep(self._delay(attempt, None))
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                time.sleep(self._delay(attempt, response.headers.get("Retry-After")))
+                continue
+            if not response.ok:
+                raise BingSearchError(f"Bing search failed with status {response.status_code}: {response.text[:200]}", response.status_code)
+            return response.json()
+
+    async def _get_asession(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._asession is None or self._asession.closed or self._asession_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._asession = aiohttp.ClientSession(connector=connector,
+                                                   headers={"Ocp-Apim-Subscription-Key": self.subscription_key},
+                                                   timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._asession_loop = loop
+            self._semaphore = asyncio.Semaphore(self.pool_size)
+        return self._asession
+
+    async def asearch(self, params: Dict) -> Dict:
+        """Async version of search, using the pooled aiohttp session"""
+        session = await self._get_asession()
+        # aiohttp only accepts str/int/float query values
+        params = {key: str(value).lower() if isinstance(value, bool) else value for key, value in params.items()}
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.aacquire()
+                try:
+                    async with session.get(self.endpoint, params=params) as response:
+                        if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                            retry_after = response.headers.get("Retry-After")
+                        elif response.status >= 400:
+                            text = await response.text()
+                            raise BingSearchError(f"Bing search failed with status {response.status}: {text[:200]}", response.status)
+                        else:
+                            return await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.max_retries:
+                        raise BingSearchError(str(e)) from e
+                    retry_after = None
+                await asyncio.sleep(self._delay(attempt, retry_after))
+
+    @staticmethod
+    def _metadata(search_results: Dict) -> List[Dict]:
+        values = search_results.get("webPages", {}).get("value", [])
+        if len(values) == 0:
+            return [{"Result": "No good Bing Search Result was found"}]
+        return [{"snippet": value["snippet"], "title": value["name"], "link": value["url"]} for value in values]
+
+    def results(self, query: str, num_results: int, **params) -> List[Dict]:
+        """Same output as BingSearchAPIWrapper.results: a list of snippet/title/link dictionaries"""
+        return self._metadata(self.search({"q": query, "count": num_results, "textDecorations": True, "textFormat": "HTML", **params}))
+
+    async def aresults(self, query: str, num_results: int, **params) -> List[Dict]:
+        return self._metadata(await self.asearch({"q": query, "count": num_results, "textDecorations": True, "textFormat": "HTML", **params}))
+
+    async def aclose(self) -> None:
+        if self._asession is not None and not self._asession.closed:
+            await self._asession.close()
+        self._asession = None
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_client: Optional[BingSearchClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> BingSearchClient:
+    """Return the process wide Bing client, configured from the environment on first use.
+
+    BING_TIMEOUT (seconds), BING_MAX_RETRIES, BING_RATE_LIMIT (requests per second, 0 for no limit)
+    and BING_MAX_CONCURRENCY (pooled connections) tune it.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = BingSearchClient(
+                timeout=float(os.environ.get("BING_TIMEOUT", 10)),
+                max_retries=int(os.environ.get("BING_MAX_RETRIES", 3)),
+                rate_limit=float(os.environ.get("BING_RATE_LIMIT", 0)),
+                pool_size=int(os.environ.get("BING_MAX_CONCURRENCY", 20)),
+            )
+        return _client
+
+
+def search(params: Dict) -> Dict:
+    return get_client().search(params)
+
+
+async def asearch(params: Dict) -> Dict:
+    return await get_client().asearch(params)
+
+
+def results(query: str, num_results: int) -> List[Dict]:
+    return get_client().results(query, num_results)
+
+
+async def aresults(query: str, num_results: int) -> List[Dict]:
+    return await get_client().aresults(query, num_results)
+
+
+async def close_session() -> None:
+    if _client is not None:
+        await _client.aclose()
@@ -0,0 +1,139 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def normalize_query(query: str) -> Tuple[str, str]:
+    """Normalize a search query and split out any `site:` restrictions.
+
+    Returns the cleaned query text and a sorted, comma separated list of sites, so that
+    "Dropped kerb cost?" and "dropped  kerb cost" share a key, and so do "site:x dropped kerb cost"
+    and "dropped kerb cost site:x". Queries restricted to different sites keep separate keys.
+    """
+    query = unicodedata.normalize("NFKC", query or "").lower()
+    sites = sorted(set(re.findall(r"\bsite:(\S+)", query)))
+    query = re.sub(r"\bsite:\S+", " ", query)
+    query = re.sub(r"\s+", " ", query).strip(" ?!.,;:\"'")
+    return query, ",".join(sites)
+
+
+def make_key(query: str, site: Optional[str] = None, mkt: Optional[str] = None, count: Optional[int] = None) -> str:
+    """Build the cache key for a search from the normalized query and its parameters"""
+    text, sites = normalize_query(query)
+    if site:
+        sites = ",".join(sorted(set(filter(None, sites.split(",") + [site.lower()]))))
+    return json.dumps([text, sites, mkt or "", count or 0])
+
+
+class SearchCache:
+    """Two level (in-process LRU + SQLite) cache for search results with a per-entry TTL.
+
+    Values must be JSON serializable. Set `path` to None to keep the cache in memory only.
+    Expired SQLite rows are deleted when the cache is opened and every `purge_every` writes,
+    so a stream of distinct queries doesn't grow the file without bound.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600, path: Optional[str] = None, purge_every: int = 1000):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.purge_every = purge_every
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._memory: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS search_cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS search_cache_expires ON search_cache (expires)")
+            self._purge()
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT expires, value FROM search_cache WHERE key = ?", (key,)).fetchone()
+                if row and row[0] > now:
+                    value = json.loads(row[1])
+                    self._remember(key, row[0], value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+                if row:
+                    self._db.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remember(key, expires, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?)", (key, expires, json.dumps(value)))
+                self._writes += 1
+                if self._writes % self.purge_every == 0:
+                    self._purge()
+                self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM search_cache")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters since the cache was created"""
+        return {"hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits, "size": len(self._memory)}
+
+    def _purge(self) -> None:
+        """Delete the expired rows; called with the lock held"""
+        self._db.execute("DELETE FROM search_cache WHERE expires <= ?", (time.time(),))
+
+    def _remember(self, key: str, expires: float, value: Any) -> None:
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+
+_search_cache: Optional[SearchCache] = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    """Return the cache shared by every search entry point, creating it on first use.
+
+    Configured through SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL (seconds) and SEARCH_CACHE_PATH
+    (set it to an empty string to keep the cache in memory only).
+    """
+    global _search_cache
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache(
+                maxsize=int(os.environ.get("SEARCH_CACHE_SIZE", 1024)),
+                ttl=float(os.environ.get("SEARCH_CACHE_TTL", 6 * 3600)),
+                path=os.environ.get("SEARCH_CACHE_PATH", ".cache/search_cache.sqlite") or None,
+            )
+        return _search_cache
@@ -1,6 +1,7 @@
 import sys
+import time
 from typing import Any, Dict, List, Optional, Union
-from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
 
@@ -29,4 +30,126 @@ class StdOutCallbackHandler(BaseCallbackHandler):
     def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
         sys.stdout.write(f"{action.log}\n")
                
-            
\ No newline at end of file
+            
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """Callback handler for streaming that puts tokens on a queue instead of stdout.
+
+    If `answer_prefix` is set (e.g. "Final Answer:" for ReAct agents), tokens of each LLM call
+    are held back until the prefix has been generated, so only the final answer is streamed.
+    Only works with LLMs that have streaming enabled.
+    """
+
+    def __init__(self, queue: Any, answer_prefix: Optional[str] = None) -> None:
+        self.queue = queue
+        self.answer_prefix = answer_prefix
+        self._buffer = ""
+        self._answering = answer_prefix is None
+
+    def _put(self, token: str) -> None:
+        self.queue.put_nowait(token)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> Any:
+        self._buffer = ""
+        self._answering = self.answer_prefix is None
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], **kwargs: Any) -> Any:
+        self.on_llm_start(serialized, [], **kwargs)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        if self._answering:
+            self._put(token)
+            return
+        self._buffer += token
+        index = self._buffer.find(self.answer_prefix)
+        if index >= 0:
+            self._answering = True
+            remainder = self._buffer[index + len(self.answer_prefix):].lstrip()
+            if remainder:
+                self._put(remainder)
+
+
+class AsyncQueueCallbackHandler(QueueCallbackHandler, AsyncCallbackHandler):
+    """Same as QueueCallbackHandler for an asyncio.Queue, used with the async chain APIs"""
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        QueueCallbackHandler.on_llm_start(self, serialized, prompts, **kwargs)
+
+    async def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], **kwargs: Any) -> None:
+        QueueCallbackHandler.on_llm_start(self, serialized, [], **kwargs)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        QueueCallbackHandler.on_llm_new_token(self, token, **kwargs)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records LLM calls (latency, time to first token, prompt/completion tokens), tool calls,
+    agent iterations and LLM errors into the request trace and the metrics registry.
+    Created by `common.metrics.callbacks()` only when metrics are enabled.
+    """
+
+    def __init__(self) -> None:
+        try:
+            from . import metrics
+        except Exception:
+            import metrics
+        self.metrics = metrics
+        self.trace = metrics.current_trace()
+        self.entry_point = self.trace["entry_point"] if self.trace else "unknown"
+        self._runs: Dict[Any, Dict[str, Any]] = {}
+
+    def _start(self, run_id: Any, **attributes: Any) -> None:
+        self._runs[run_id] = {"start": time.perf_counter(), **attributes}
+
+    def _finish(self, stage: str, run_id: Any, **attributes: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            start = run.pop("start")
+            self.metrics.record_span(stage, start, time.perf_counter() - start, trace=self.trace, **run, **attributes)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> Any:
+        self._start(kwargs.get("run_id"), tokens_streamed=0)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], **kwargs: Any) -> Any:
+        self._start(kwargs.get("run_id"), tokens_streamed=0)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        run = self._runs.get(kwargs.get("run_id"))
+        if run is None:
+            return
+        if not run["tokens_streamed"]:
+            run["time_to_first_token"] = round(time.perf_counter() - run["start"], 6)
+            self.metrics.observe("llm_time_to_first_token_seconds", run["time_to_first_token"], entry_point=self.entry_point)
+        run["tokens_streamed"] += 1
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> Any:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        run = self._runs.get(kwargs.get("run_id"), {})
+        # Streaming responses carry no usage, count the streamed chunks instead
+        completion_tokens = usage.get("completion_tokens") or run.get("tokens_streamed", 0)
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        if prompt_tokens:
+            self.metrics.observe("llm_prompt_tokens", prompt_tokens, self.metrics.TOKEN_BUCKETS, entry_point=self.entry_point)
+        if completion_tokens:
+            self.metrics.observe("llm_completion_tokens", completion_tokens, self.metrics.TOKEN_BUCKETS, entry_point=self.entry_point)
+        self._finish("llm", kwargs.get("run_id"), prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> Any:
+        self.metrics.inc("llm_errors_total", entry_point=self.entry_point, error=type(error).__name__)
+        self._finish("llm", kwargs.get("run_id"), error=type(error).__name__)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
+        self.metrics.inc("tool_invocations_total", entry_point=self.entry_point, tool=serialized.get("name", ""))
+        self._start(kwargs.get("run_id"), tool=serialized.get("name", ""))
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> Any:
+        self._finish("tool", kwargs.get("run_id"))
+
+    def on_tool_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> Any:
+        self._finish("tool", kwargs.get("run_id"), error=type(error).__name__)
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        self.metrics.inc("agent_iterations_total", entry_point=self.entry_point)
+        if self.trace is not None:
+            self.trace["agent_iterations"] = self.trace.get("agent_iterations", 0) + 1
@@ -0,0 +1,33 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+
+# Azure OpenAI settings in credentials.env and the OPENAI_* variables langchain reads them from
+AZURE_OPENAI_SETTINGS = {
+    "OPENAI_API_BASE": "AZURE_OPENAI_ENDPOINT",
+    "OPENAI_API_KEY": "AZURE_OPENAI_API_KEY",
+    "OPENAI_API_VERSION": "AZURE_OPENAI_API_VERSION",
+}
+
+_configured = False
+_lock = threading.Lock()
+
+
+def configure_environment(path: str = "credentials.env") -> None:
+    """Load the credentials file and point langchain's OpenAI clients at Azure OpenAI.
+
+    Call it once before building any LLM or search client; later calls do nothing. Variables
+    already set in the environment win over the file, and missing Azure settings are left unset
+    so that building a client reports them instead of this function failing.
+    """
+    global _configured
+    with _lock:
+        if _configured:
+            return
+        load_dotenv(path)
+        for name, azure_name in AZURE_OPENAI_SETTINGS.items():
+            if os.environ.get(azure_name):
+                os.environ[name] = os.environ[azure_name]
+        os.environ["OPENAI_API_TYPE"] = "azure"
+        _configured = True
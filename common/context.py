@@ -0,0 +1,89 @@
+import html
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token budget for the web results placed in a prompt
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", 1500))
+
+TAG_RE = re.compile(r"<[^>]+>")
+SPACE_RE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    """tiktoken encoding for the model, or None if tiktoken or its encoding files are unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"tiktoken unavailable, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Number of tokens in `text` for the model, estimated at 4 characters per token without tiktoken"""
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def clean_text(text: str) -> str:
+    """Strip HTML markup and entities and collapse whitespace"""
+    return SPACE_RE.sub(" ", html.unescape(TAG_RE.sub("", text or ""))).strip()
+
+
+def _truncate(text: str, max_tokens: int, model: str) -> str:
+    encoding = _encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def compact_results(results: List[Dict], max_tokens: int = CONTEXT_MAX_TOKENS, model: str = "gpt-3.5-turbo") -> List[Dict]:
+    """Reduce search results to clean snippet/title/link dictionaries within a token budget.
+
+    Accepts raw Bing values (name/url/snippet) as well as tool results (title/link/snippet).
+    Markup is stripped, results with a repeated link or snippet are dropped and results are kept
+    in rank order until the budget is spent; the last one is truncated to fit.
+    """
+    compacted = []
+    seen_links, seen_snippets = set(), set()
+    budget = max_tokens
+    for result in results:
+        if "snippet" not in result:
+            continue
+        link = result.get("link") or result.get("url", "")
+        snippet = clean_text(result["snippet"])
+        key = snippet.lower()
+        if link in seen_links or key in seen_snippets:
+            continue
+        seen_links.add(link)
+        seen_snippets.add(key)
+
+        item = {"snippet": snippet, "title": clean_text(result.get("title") or result.get("name", "")), "link": link}
+        cost = count_tokens(repr(item), model)
+        if cost > budget:
+            overflow = cost - count_tokens(snippet, model)
+            if budget - overflow > 20:
+                item["snippet"] = _truncate(snippet, budget - overflow, model)
+                compacted.append(item)
+            break
+        compacted.append(item)
+        budget -= cost
+    return compacted or results
+
+
+def build_context(results: List[Dict], max_tokens: int = CONTEXT_MAX_TOKENS, model: str = "gpt-3.5-turbo") -> str:
+    """Text to place in a prompt for these results, in the list-of-dictionaries form the prompts describe"""
+    return repr(compact_results(results, max_tokens=max_tokens, model=model))
@@ -0,0 +1,79 @@
+import asyncio
+import contextvars
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List
+
+try:
+    from .memory import standalone_query
+    from .router import JOINED_QUESTION_RE, LEADING_CONNECTIVE_RE, QUESTION_WORDS, asking_sentences
+except Exception as e:
+    print(e)
+    from memory import standalone_query
+    from router import JOINED_QUESTION_RE, LEADING_CONNECTIVE_RE, QUESTION_WORDS, asking_sentences
+
+###
+# Compound questions ("What options are available for Adult Social care? How much would they cost?")
+# are split into one search query per part, the searches run at once and their results are merged,
+# so the question is answered with one search round trip and one LLM call instead of an agent step
+# per part.
+###
+
+# Most searches run for one question; later parts are dropped
+MAX_SUB_QUERIES = int(os.environ.get("MAX_SUB_QUERIES", 4))
+
+def _split_joined(sentence: str) -> List[str]:
+    """Split "How do I apply and how much does it cost?" before each joined question word"""
+    parts, start = [], 0
+    for match in JOINED_QUESTION_RE.finditer(sentence):
+        parts.append(sentence[start:match.start()])
+        start = match.start(3)
+    parts.append(sentence[start:])
+    return [p.strip(" ,;") for p in parts if p.strip(" ,;")]
+
+
+def decompose(question: str, max_queries: int = MAX_SUB_QUERIES) -> List[str]:
+    """Search queries for the parts of a compound question, without an LLM call.
+
+    A question asking one thing is returned as is. Parts that refer back ("How much would they
+    cost?") get the key terms of the first part added, so each query stands on its own.
+    """
+    text = LEADING_CONNECTIVE_RE.sub("", question.strip())
+    parts = [part for sentence in asking_sentences(text) for part in _split_joined(sentence)]
+    # Fragments that ask nothing ("as soon as possible") would be junk queries
+    parts = [part for part in parts if part.endswith("?") or re.match(QUESTION_WORDS + r"\b", part, re.IGNORECASE)]
+    if len(parts) < 2:
+        return [question]
+    queries = [parts[0]] + [standalone_query(part, parts[0]) for part in parts[1:]]
+    return list(dict.fromkeys(queries))[:max_queries]
+
+
+def merge_web_pages(responses: List[Dict]) -> Dict:
+    """One Bing response out of several: their results interleaved by rank, repeated links dropped"""
+    ranked = [r.get("webPages", {}).get("value", []) for r in responses]
+    merged, seen = [], set()
+    for rank in range(max((len(values) for values in ranked), default=0)):
+        for values in ranked:
+            if rank < len(values) and values[rank].get("url") not in seen:
+                seen.add(values[rank].get("url"))
+                merged.append(values[rank])
+    return {"webPages": {"value": merged}} if merged else {}
+
+
+def search_all(queries: List[str], search: Callable[[str], Dict]) -> Dict:
+    """Run `search` for every query at once and merge the responses"""
+    if len(queries) == 1:
+        return search(queries[0])
+    # The request's own threads, so sub-searches never queue behind other requests'; one context
+    # copy per query, so each search reports into the caller's trace
+    contexts = [contextvars.copy_context() for _ in queries]
+    with ThreadPoolExecutor(max_workers=len(queries), thread_name_prefix="sub-search") as pool:
+        return merge_web_pages(list(pool.map(lambda context, query: context.run(search, query), contexts, queries)))
+
+
+async def asearch_all(queries: List[str], search: Callable[[str], Awaitable[Dict]]) -> Dict:
+    """Async version of search_all"""
+    if len(queries) == 1:
+        return await search(queries[0])
+    return merge_web_pages(await asyncio.gather(*(search(query) for query in queries)))
@@ -0,0 +1,379 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.tools import BaseTool
+
+try:
+    from .local_index import chunk_text, ingest_snapshot, make_snippet, tokenize
+except Exception as e:
+    print(e)
+    from local_index import chunk_text, ingest_snapshot, make_snippet, tokenize
+
+BLOCK_ROWS = 8192
+
+
+class VectorStore:
+    """Append-only matrix of embeddings in a memory-mapped file, stored as int8 or float16.
+
+    int8 rows are quantized with their own scale (max absolute value / 127), which keeps cosine
+    ranking close to float32 at a quarter of the size. `rows(ids)` and `dot()` work in float32.
+    """
+
+    def __init__(self, path: str, dim: int, dtype: str = "int8", capacity: int = 1024):
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.scales = np.ones(0, dtype=np.float32)
+        self._open(max(capacity, 1), "w+" if not os.path.exists(path) else "r+")
+
+    def _open(self, capacity: int, mode: str) -> None:
+        if mode == "r+":
+            capacity = max(capacity, os.path.getsize(self.path) // (self.dim * self.dtype.itemsize))
+        self.capacity = capacity
+        self.matrix = np.memmap(self.path, dtype=self.dtype, mode=mode, shape=(capacity, self.dim))
+        if len(self.scales) < capacity:
+            self.scales = np.concatenate([self.scales, np.ones(capacity - len(self.scales), dtype=np.float32)])
+
+    def _grow(self, needed: int) -> None:
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        self.matrix.flush()
+        del self.matrix
+        with open(self.path, "r+b") as f:
+            f.truncate(capacity * self.dim * self.dtype.itemsize)
+        self._open(capacity, "r+")
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """Append L2-normalized vectors, returning their row ids"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if self.size + len(vectors) > self.capacity:
+            self._grow(self.size + len(vectors))
+        rows = np.arange(self.size, self.size + len(vectors))
+        if self.dtype == np.int8:
+            scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+            self.matrix[rows] = np.round(vectors / scales[:, None]).astype(np.int8)
+            self.scales[rows] = scales
+        else:
+            self.matrix[rows] = vectors.astype(self.dtype)
+        self.size += len(vectors)
+        return rows
+
+    def rows(self, ids: np.ndarray) -> np.ndarray:
+        block = self.matrix[ids].astype(np.float32)
+        return block * self.scales[ids, None] if self.dtype == np.int8 else block
+
+    def dot(self, query: np.ndarray, ids: Optional[np.ndarray] = None) -> np.ndarray:
+        """Dot product of the query with the given rows (all rows if None), converted block by block"""
+        if ids is not None:
+            return self.rows(ids) @ query
+        out = np.empty(self.size, dtype=np.float32)
+        buffer = np.empty((min(BLOCK_ROWS, max(self.size, 1)), self.dim), dtype=np.float32)
+        for start in range(0, self.size, BLOCK_ROWS):
+            end = min(self.size, start + BLOCK_ROWS)
+            np.copyto(buffer[:end - start], self.matrix[start:end], casting="unsafe")
+            np.dot(buffer[:end - start], query, out=out[start:end])
+        if self.dtype == np.int8:
+            out *= self.scales[:self.size]
+        return out
+
+    def flush(self) -> None:
+        self.matrix.flush()
+
+
+class SparseIndex:
+    """BM25 inverted index that supports adding chunks one page at a time; deleted chunks are masked out"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, array] = {}
+        self.freqs: Dict[str, array] = {}
+        self.doc_lens = array("f")
+        self.total_len = 0.0
+
+    def add(self, doc_id: int, text: str) -> None:
+        tokens = tokenize(text)
+        while len(self.doc_lens) <= doc_id:
+            self.doc_lens.append(0.0)
+        self.doc_lens[doc_id] = len(tokens)
+        self.total_len += len(tokens)
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, array("I")).append(doc_id)
+            self.freqs.setdefault(term, array("H")).append(min(tf, 65535))
+
+    def remove(self, doc_id: int) -> None:
+        # Postings keep the id; the caller's alive mask zeroes its score
+        self.total_len -= self.doc_lens[doc_id]
+
+    def scores(self, query: str, n: int, live: int) -> np.ndarray:
+        scores = np.zeros(n, dtype=np.float32)
+        if not live:
+            return scores
+        doc_lens = np.frombuffer(self.doc_lens, dtype=np.float32)[:n]
+        norm = self.k1 * (1 - self.b + self.b * doc_lens / max(self.total_len / live, 1e-6))
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            docs = np.frombuffer(self.postings[term], dtype=np.uint32)
+            tf = np.frombuffer(self.freqs[term], dtype=np.uint16).astype(np.float32)
+            idf = math.log(1 + (live - len(docs) + 0.5) / (len(docs) + 0.5)) if len(docs) < live else 0.01
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm[docs])
+        return scores
+
+
+class HybridIndex:
+    """Document chunks searchable by embedding similarity fused with BM25.
+
+    Pages can be added, replaced and deleted one at a time. Replaced and deleted chunks are
+    tombstoned rather than rewritten, so re-ingesting a changed page only embeds that page.
+    Above `ivf_min_rows` chunks the dense search only scores the rows of the `nprobe` k-means
+    lists closest to the query plus the best BM25 candidates, instead of the whole matrix.
+    """
+
+    def __init__(self, path: str, embeddings: Embeddings, dtype: str = "int8", chunk_words: int = 120,
+                 alpha: float = 0.6, ivf_min_rows: int = 20000, nprobe: int = 8):
+        self.path = path
+        self.embeddings = embeddings
+        self.dtype = dtype
+        self.chunk_words = chunk_words
+        self.alpha = alpha
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self.chunks: List[Dict] = []
+        self.pages: Dict[str, Dict] = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.sparse = SparseIndex()
+        self.vectors: Optional[VectorStore] = None
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self._lists: Optional[List[np.ndarray]] = None
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    ######## INGESTION ########################################
+
+    def add_page(self, link: str, title: str, text: str) -> bool:
+        """Index a page, replacing its previous version. Returns False if the page is unchanged."""
+        digest = hashlib.sha1((title + "\n" + text).encode("utf-8")).hexdigest()
+        if self.pages.get(link, {}).get("hash") == digest:
+            return False
+        passages = chunk_text(text, self.chunk_words)
+        vectors = np.asarray(self.embeddings.embed_documents([title + "\n" + p for p in passages]), dtype=np.float32) if passages else None
+
+        with self._lock:
+            self.delete_page(link)
+            if vectors is None:
+                return True
+            if self.vectors is None:
+                self.vectors = VectorStore(os.path.join(self.path, "vectors.bin"), vectors.shape[1], self.dtype)
+            rows = self.vectors.add(vectors)
+            self.alive = np.concatenate([self.alive, np.ones(len(rows), dtype=bool)])
+            for row, passage in zip(rows, passages):
+                self.chunks.append({"link": link, "title": title, "text": passage})
+                self.sparse.add(int(row), title + " " + passage)
+            self.pages[link] = {"hash": digest, "rows": rows.tolist()}
+            if self.centroids is not None:
+                self._assign(rows)
+            return True
+
+    def delete_page(self, link: str) -> None:
+        with self._lock:
+            page = self.pages.pop(link, None)
+            if page:
+                for row in page["rows"]:
+                    if self.alive[row]:
+                        self.alive[row] = False
+                        self.sparse.remove(row)
+
+    def save(self) -> None:
+        """Persist the chunk metadata (vectors are already on disk), training the IVF lists if due"""
+        with self._lock:
+            if self.centroids is None and self.alive.sum() >= self.ivf_min_rows:
+                self.train()
+            if self.vectors is not None:
+                self.vectors.flush()
+                np.save(os.path.join(self.path, "scales.npy"), self.vectors.scales[:self.vectors.size])
+            if self.centroids is not None:
+                np.save(os.path.join(self.path, "centroids.npy"), self.centroids)
+                np.save(os.path.join(self.path, "assignments.npy"), self.assignments)
+            np.save(os.path.join(self.path, "alive.npy"), self.alive)
+            with open(os.path.join(self.path, "chunks.json"), "w", encoding="utf-8") as f:
+                json.dump({"chunks": self.chunks, "pages": self.pages,
+                           "dim": self.vectors.dim if self.vectors else 0, "dtype": self.dtype}, f, ensure_ascii=False)
+
+    def _load(self) -> None:
+        state_path = os.path.join(self.path, "chunks.json")
+        if not os.path.exists(state_path):
+            return
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        self.chunks, self.pages, self.dtype = state["chunks"], state["pages"], state["dtype"]
+        self.alive = np.load(os.path.join(self.path, "alive.npy"))
+        if state["dim"]:
+            self.vectors = VectorStore(os.path.join(self.path, "vectors.bin"), state["dim"], self.dtype)
+            self.vectors.size = len(self.chunks)
+            self.vectors.scales[:self.vectors.size] = np.load(os.path.join(self.path, "scales.npy"))
+        for row, chunk in enumerate(self.chunks):
+            self.sparse.add(row, chunk["title"] + " " + chunk["text"])
+            if not self.alive[row]:
+                self.sparse.remove(row)
+        if os.path.exists(os.path.join(self.path, "centroids.npy")):
+            self.centroids = np.load(os.path.join(self.path, "centroids.npy"))
+            self.assignments = np.load(os.path.join(self.path, "assignments.npy"))
+            self._lists = None
+
+    ######## IVF ##############################################
+
+    def train(self, n_lists: Optional[int] = None, iterations: int = 10, sample: int = 50000) -> None:
+        """Cluster the live vectors with spherical k-means; each query then probes `nprobe` clusters"""
+        live = np.flatnonzero(self.alive)
+        n_lists = n_lists or max(16, int(math.sqrt(len(live))))
+        rng = np.random.default_rng(0)
+        data = self.vectors.rows(np.sort(rng.choice(live, min(sample, len(live)), replace=False)))
+        centroids = data[rng.choice(len(data), n_lists, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(data @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = data[labels == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        self.centroids = centroids
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self._assign(np.arange(self.vectors.size))
+
+    def _assign(self, rows: np.ndarray) -> None:
+        labels = np.concatenate([np.argmax(self.vectors.rows(rows[i:i + BLOCK_ROWS]) @ self.centroids.T, axis=1)
+                                 for i in range(0, len(rows), BLOCK_ROWS)]).astype(np.int32)
+        if len(self.assignments) < self.vectors.size:
+            self.assignments = np.concatenate([self.assignments, np.zeros(self.vectors.size - len(self.assignments), dtype=np.int32)])
+        self.assignments[rows] = labels
+        self._lists = None
+
+    def _candidates(self, query_vector: np.ndarray, sparse: np.ndarray) -> np.ndarray:
+        if self._lists is None:
+            order = np.argsort(self.assignments[:self.vectors.size], kind="stable")
+            bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        probes = np.argpartition(-(self.centroids @ query_vector), min(self.nprobe, len(self.centroids) - 1))[:self.nprobe]
+        top_sparse = np.flatnonzero(sparse)
+        if len(top_sparse) > 200:
+            top_sparse = top_sparse[np.argpartition(-sparse[top_sparse], 200)[:200]]
+        return np.unique(np.concatenate([self._lists[p] for p in probes] + [top_sparse]))
+
+    ######## SEARCH ###########################################
+
+    def search(self, query: str, k: int = 5) -> List[Dict]:
+        """Best chunks for the query by alpha * cosine + (1 - alpha) * normalized BM25, one per page"""
+        if self.vectors is None:
+            return []
+        # The embedding is a remote call, made before taking the lock so concurrent searches don't queue behind it
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        query_vector /= max(np.linalg.norm(query_vector), 1e-12)
+        with self._lock:
+            if self.vectors is None or not self.alive.any():
+                return []
+            n = self.vectors.size
+
+            sparse = self.sparse.scores(query, n, int(self.alive.sum()))
+            if sparse.max() > 0:
+                sparse /= sparse.max()
+            if self.centroids is not None:
+                ids = self._candidates(query_vector, sparse)
+                scores = np.full(n, -np.inf, dtype=np.float32)
+                scores[ids] = self.alpha * self.vectors.dot(query_vector, ids) + (1 - self.alpha) * sparse[ids]
+            else:
+                scores = self.alpha * self.vectors.dot(query_vector) + (1 - self.alpha) * sparse
+            scores[~self.alive[:n]] = -np.inf
+
+            top = min(len(scores), k * 5)
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+
+            terms, results, seen = tokenize(query), [], set()
+            for row in best:
+                chunk = self.chunks[row]
+                if not np.isfinite(scores[row]) or chunk["link"] in seen:
+                    continue
+                seen.add(chunk["link"])
+                results.append({"snippet": make_snippet(chunk["text"], terms), "title": chunk["title"], "link": chunk["link"]})
+                if len(results) == k:
+                    break
+            return results
+
+
+_doc_index: Optional[HybridIndex] = None
+_doc_index_lock = threading.Lock()
+
+
+def get_doc_index() -> HybridIndex:
+    """Index shared by every DocSearchTool, at DOCSEARCH_INDEX_PATH, embedded with EMBEDDING_DEPLOYMENT_NAME"""
+    global _doc_index
+    with _doc_index_lock:
+        if _doc_index is None:
+            from langchain.embeddings import OpenAIEmbeddings
+            embeddings = OpenAIEmbeddings(deployment=os.environ.get("EMBEDDING_DEPLOYMENT_NAME", "text-embedding-ada-002"), chunk_size=16)
+            _doc_index = HybridIndex(os.environ.get("DOCSEARCH_INDEX_PATH", ".index/docsearch"), embeddings,
+                                     dtype=os.environ.get("DOCSEARCH_DTYPE", "int8"))
+        return _doc_index
+
+
+######## TOOL CLASSES #####################################
+###########################################################
+
+class DocSearchTool(BaseTool):
+    """Tool for the local hybrid document search index"""
+
+    name = "@docsearch"
+    description = "useful when the questions includes the term: @docsearch.\n"
+
+    k: int = 5
+    index: Any = None
+
+    def _run(self, query: str) -> str:
+        try:
+            return (self.index or get_doc_index()).search(query, k=self.k) or "No Results Found"
+        except Exception as e:
+            print(e)
+            return "No Results Found"
+
+    async def _arun(self, query: str) -> str:
+        """Use the tool asynchronously."""
+        return await asyncio.to_thread(self._run, query)
+
+
+###
+# Add (or refresh) the pages of a site snapshot saved by common.local_index in the document search index:
+#   python -m common.docsearch ingest .index/snapshot
+#   python -m common.docsearch search "dropped kerb cost"
+###
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hybrid document search index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("ingest").add_argument("snapshot")
+    commands.add_parser("search").add_argument("query")
+    args = parser.parse_args()
+
+    index = get_doc_index()
+    if args.command == "ingest":
+        changed = sum(index.add_page(url, title, text) for url, title, text in ingest_snapshot(args.snapshot))
+        index.save()
+        print(changed, "pages added or updated")
+    else:
+        for result in index.search(args.query):
+            print(json.dumps(result, ensure_ascii=False))
@@ -0,0 +1,105 @@
+import io
+import re
+from html.parser import HTMLParser
+from typing import List, Tuple
+from urllib.parse import urljoin, urldefrag
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+SKIP_TAGS = {"script", "style", "noscript", "nav", "header", "footer", "form", "svg", "iframe", "template", "aside"}
+BLOCK_TAGS = {"p", "div", "br", "li", "ul", "ol", "tr", "table", "section", "article", "main",
+              "h1", "h2", "h3", "h4", "h5", "h6", "dd", "dt", "blockquote"}
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the title, visible text and links of an HTML page, preferring the <main> element"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.links: List[str] = []
+        self._parts: List[str] = []
+        self._main_parts: List[str] = []
+        self._skip = 0
+        self._main = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag == "main" or (tag == "div" and ("role", "main") in attrs):
+            self._main += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self.links.append(href)
+        if tag in BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self._skip:
+            self._skip -= 1
+        elif tag == "main" and self._main:
+            self._main -= 1
+        elif tag == "title":
+            self._in_title = False
+        if tag in BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip:
+            self._append(data)
+
+    def _append(self, text: str) -> None:
+        self._parts.append(text)
+        if self._main:
+            self._main_parts.append(text)
+
+    def text(self) -> str:
+        parts = self._main_parts if "".join(self._main_parts).strip() else self._parts
+        return normalize_whitespace("".join(parts))
+
+
+def normalize_whitespace(text: str) -> str:
+    lines = (re.sub(r"[ \t\r\f\v\xa0]+", " ", line).strip() for line in text.split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def extract_html(html: str, base_url: str = "") -> Tuple[str, str, List[str]]:
+    """Title, main text and absolute links (without fragments) of an HTML page"""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    links = [urldefrag(urljoin(base_url, link))[0] for link in parser.links]
+    return normalize_whitespace(parser.title), parser.text(), links
+
+
+def extract_pdf(data: bytes) -> Tuple[str, str]:
+    """Title and text of a PDF document; empty if pypdf is not installed"""
+    if PdfReader is None:
+        return "", ""
+    reader = PdfReader(io.BytesIO(data))
+    title = ""
+    if reader.metadata and reader.metadata.title:
+        title = str(reader.metadata.title)
+    text = "\n".join(page.extract_text() or "" for page in reader.pages)
+    return title, normalize_whitespace(text)
+
+
+def extract(body: bytes, content_type: str, url: str = "") -> Tuple[str, str, List[str]]:
+    """Title, text and links of a downloaded HTML page or PDF"""
+    if "pdf" in content_type or url.lower().endswith(".pdf"):
+        title, text = extract_pdf(body)
+        return title, text, []
+    charset = "utf-8"
+    match = re.search(r"charset=([\w-]+)", content_type or "")
+    if match:
+        charset = match.group(1)
+    return extract_html(body.decode(charset, errors="replace"), url)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from .extract import extract
+    from .local_index import chunk_text, tokenize
+except Exception as e:
+    print(e)
+    from extract import extract
+    from local_index import chunk_text, tokenize
+
+FETCH_PAGES = os.environ.get("FETCH_PAGES", "true").lower() == "true"
+FETCH_TOP_K = int(os.environ.get("FETCH_TOP_K", 3))
+FETCH_MAX_WORKERS = int(os.environ.get("FETCH_MAX_WORKERS", 5))
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", 5))
+
+
+class PageCache:
+    """Extracted page text, stored once per distinct response body (keyed by its SHA-256).
+
+    A SQLite table maps each URL to its current body digest and the ETag/Last-Modified
+    validators, so stale entries are revalidated with a conditional GET instead of re-downloaded.
+    """
+
+    def __init__(self, path: str = ".cache/pages", max_age: float = 3600):
+        self.path = path
+        self.max_age = max_age
+        os.makedirs(path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, "pages.sqlite"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, digest TEXT, etag TEXT, last_modified TEXT, checked REAL)")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def lookup(self, url: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute("SELECT digest, etag, last_modified, checked FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None or not os.path.exists(self._file(row[0])):
+            return None
+        return {"digest": row[0], "etag": row[1], "last_modified": row[2], "fresh": time.time() - row[3] < self.max_age}
+
+    def load(self, digest: str) -> Dict:
+        with open(self._file(digest), encoding="utf-8") as f:
+            return json.load(f)
+
+    def store(self, url: str, body: bytes, page: Dict, etag: Optional[str], last_modified: Optional[str]) -> None:
+        digest = hashlib.sha256(body).hexdigest()
+        if not os.path.exists(self._file(digest)):
+            with open(self._file(digest), "w", encoding="utf-8") as f:
+                json.dump(page, f, ensure_ascii=False)
+        self._record(url, digest, etag, last_modified)
+
+    def touch(self, url: str) -> None:
+        with self._lock:
+            self._db.execute("UPDATE pages SET checked = ? WHERE url = ?", (time.time(), url))
+            self._db.commit()
+
+    def _record(self, url: str, digest: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", (url, digest, etag, last_modified, time.time()))
+            self._db.commit()
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.path, digest + ".json")
+
+
+class PageFetcher:
+    """Downloads result pages concurrently through a bounded pool and extracts their text, using the page cache"""
+
+    def __init__(self, cache: PageCache, max_workers: int = FETCH_MAX_WORKERS, timeout: float = FETCH_TIMEOUT):
+        self.cache = cache
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="page-fetch")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = "lcc-assistant/1.0"
+
+    def fetch(self, url: str) -> Optional[Dict]:
+        """{'title', 'text'} of the page, or None if it can't be fetched"""
+        cached = self.cache.lookup(url)
+        if cached and cached["fresh"]:
+            return self.cache.load(cached["digest"])
+
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"{url}: {e}")
+            return self.cache.load(cached["digest"]) if cached else None
+
+        if response.status_code == 304 and cached:
+            self.cache.touch(url)
+            return self.cache.load(cached["digest"])
+        if not response.ok:
+            return None
+        try:
+            title, text, _ = extract(response.content, response.headers.get("Content-Type", ""), url)
+        except Exception as e:
+            # Malformed PDF, unknown charset...: the result keeps its snippet
+            print(f"{url}: {e}")
+            return None
+        page = {"title": title, "text": text}
+        self.cache.store(url, response.content, page, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return page
+
+    def fetch_all(self, urls: List[str]) -> List[Optional[Dict]]:
+        return list(self.pool.map(self.fetch, urls))
+
+
+def relevant_passages(question: str, text: str, max_passages: int = 2, words: int = 80) -> str:
+    """The passages of a page sharing the most query terms with the question, in page order"""
+    terms = set(tokenize(question))
+    passages = chunk_text(text, words)
+    scored = [(len(terms.intersection(tokenize(p))), i) for i, p in enumerate(passages)]
+    best = sorted(i for score, i in sorted(scored, reverse=True)[:max_passages] if score > 0)
+    return " ... ".join(passages[i] for i in best)
+
+
+def enrich_results(question: str, results: List[Dict], top_k: int = FETCH_TOP_K) -> List[Dict]:
+    """Add the most relevant passages of the top-k result pages to their snippets.
+
+    Works on raw Bing values (url/snippet) and tool results (link/snippet); results whose page
+    can't be fetched keep their original snippet.
+    """
+    top = [r for r in results[:top_k] if r.get("url") or r.get("link")]
+    pages = get_fetcher().fetch_all([r.get("url") or r.get("link") for r in top])
+    enriched = {}
+    for result, page in zip(top, pages):
+        passages = relevant_passages(question, page["text"]) if page else ""
+        if passages:
+            enriched[id(result)] = {**result, "snippet": result.get("snippet", "") + " ... " + passages}
+    return [enriched.get(id(r), r) for r in results]
+
+
+_fetcher: Optional[PageFetcher] = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher() -> PageFetcher:
+    """Fetcher shared by every pipeline, caching pages under PAGE_CACHE_PATH for PAGE_MAX_AGE seconds"""
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            cache = PageCache(os.environ.get("PAGE_CACHE_PATH", ".cache/pages"), float(os.environ.get("PAGE_MAX_AGE", 3600)))
+            _fetcher = PageFetcher(cache)
+        return _fetcher
@@ -0,0 +1,329 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import openai
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models import AzureChatOpenAI
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import BaseMessage, ChatResult
+
+try:
+    from .context import count_tokens
+    from .router import SIMPLE, current_path
+    from . import metrics
+except Exception as e:
+    print(e)
+    from context import count_tokens
+    from router import SIMPLE, current_path
+    import metrics
+
+###
+# Several Azure OpenAI deployments (models, regions, resources) behind one chat model.
+# LLM_DEPLOYMENTS is a JSON list, inline or in a .json file, with one entry per deployment:
+#   [{"deployment": "gpt-35-turbo-16k", "endpoint": "https://uksouth.openai.azure.com/", "api_key_env": "AZURE_OPENAI_API_KEY_UKS", "tpm": 120000},
+#    {"deployment": "gpt-35-turbo", "endpoint": "https://swedencentral.openai.azure.com/", "tpm": 240000, "tier": "fast"}]
+# "endpoint", "api_key" (or "api_key_env", the variable holding it) and "api_version" default to the
+# AZURE_OPENAI_* settings. "tier" is "default" or "fast"; questions routed as simple try the fast tier first.
+# Without LLM_DEPLOYMENTS build_chat_model returns a plain AzureChatOpenAI, as before.
+###
+LLM_DEPLOYMENTS = os.environ.get("LLM_DEPLOYMENTS", "")
+# Consecutive failures after which a deployment is skipped for LLM_BREAKER_COOLDOWN seconds
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", 3))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", 30))
+# How long a throttled deployment is skipped when the 429 has no Retry-After
+LLM_THROTTLE_COOLDOWN = float(os.environ.get("LLM_THROTTLE_COOLDOWN", 10))
+
+DEFAULT_TIER = "default"
+FAST_TIER = "fast"
+# Tier tried first for each router path; other paths (and unrouted calls) prefer the default tier
+PATH_TIERS = {SIMPLE: FAST_TIER}
+
+# Errors worth trying another deployment for; anything else (bad request, content filter) is raised as is
+TRANSIENT_ERRORS = (openai.error.Timeout, openai.error.APIError, openai.error.APIConnectionError,
+                    openai.error.ServiceUnavailableError, openai.error.TryAgain)
+
+WINDOW_SECONDS = 60.0
+
+
+class NoDeploymentAvailable(openai.error.RateLimitError):
+    """Every deployment of the pool is throttled or failing; callers back off as they would when throttled"""
+
+
+class DeploymentState:
+    """Tokens used in the last minute and circuit breaker of one deployment, shared by every pool using it.
+
+    The breaker opens after LLM_BREAKER_FAILURES consecutive errors (or at once on a 429) and lets a
+    single probe call through once the cooldown is over; a successful call closes it again.
+    """
+
+    def __init__(self, name: str, tpm: int, tier: str = DEFAULT_TIER):
+        self.name = name
+        self.tpm = tpm
+        self.tier = tier
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.window: Deque[Tuple[float, int]] = deque()
+        self._lock = threading.Lock()
+
+    def _used(self, now: float) -> int:
+        while self.window and now - self.window[0][0] > WINDOW_SECONDS:
+            self.window.popleft()
+        return sum(tokens for _, tokens in self.window)
+
+    def headroom(self) -> int:
+        """Tokens left in this minute's budget"""
+        with self._lock:
+            return self.tpm - self._used(time.monotonic())
+
+    def available(self) -> bool:
+        with self._lock:
+            return not self.probing and time.monotonic() >= self.open_until
+
+    def begin(self, tokens: int) -> bool:
+        """Reserve the estimated tokens of a call, False if the circuit doesn't let it through.
+
+        After a cooldown only the first caller gets through, as the probe; the others are turned
+        away until it completes.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.probing or now < self.open_until:
+                return False
+            if self.open_until:
+                self.probing = True
+            self.window.append((now, tokens))
+            return True
+
+    def release(self, estimated: int) -> None:
+        """Drop the reservation of a call that failed for reasons unrelated to the deployment"""
+        with self._lock:
+            self.window.append((time.monotonic(), -estimated))
+            self.probing = False
+
+    def succeeded(self, estimated: int, used: int) -> None:
+        with self._lock:
+            self.window.append((time.monotonic(), used - estimated))
+            self.failures = 0
+            self.open_until = 0.0
+            self.probing = False
+
+    def failed(self, estimated: int, cooldown: Optional[float] = None) -> None:
+        """Record a failed call; `cooldown` opens the breaker at once (throttling)"""
+        now = time.monotonic()
+        with self._lock:
+            self.window.append((now, -estimated))
+            self.failures += 1
+            if cooldown is None and (self.probing or self.failures >= LLM_BREAKER_FAILURES):
+                cooldown = LLM_BREAKER_COOLDOWN
+            if cooldown is not None:
+                self.open_until = now + cooldown
+            self.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            state = "open" if now < self.open_until else "half-open" if self.probing else "closed"
+            return {"tier": self.tier, "tpm": self.tpm, "tokens_last_minute": self._used(now),
+                    "failures": self.failures, "circuit": state}
+
+
+_states: Dict[Tuple[str, str], DeploymentState] = {}
+_states_lock = threading.Lock()
+
+
+def deployment_state(config: Dict) -> DeploymentState:
+    key = (config.get("endpoint") or "", config["deployment"])
+    with _states_lock:
+        if key not in _states:
+            _states[key] = DeploymentState(config.get("name") or config["deployment"], int(config.get("tpm", 120000)),
+                                           config.get("tier", DEFAULT_TIER))
+        return _states[key]
+
+
+def load_deployments(value: str = LLM_DEPLOYMENTS) -> List[Dict]:
+    """Deployment entries from LLM_DEPLOYMENTS (inline JSON or the path of a JSON file)"""
+    if not value:
+        return []
+    if value.strip().startswith("["):
+        return json.loads(value)
+    with open(value, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _retry_after(error: Exception) -> float:
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return LLM_THROTTLE_COOLDOWN
+
+
+class _TokenWatch:
+    """Run manager passed to a member, noting whether it has streamed any token yet"""
+
+    def __init__(self, run_manager):
+        self._run_manager = run_manager
+        self.streamed = False
+
+    def on_llm_new_token(self, *args: Any, **kwargs: Any):
+        self.streamed = True
+        # Returns the coroutine for async run managers
+        return self._run_manager.on_llm_new_token(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._run_manager, name)
+
+
+class LLMPool(BaseChatModel):
+    """Chat model sending each call to one of several Azure OpenAI deployments.
+
+    Deployments whose circuit is open are skipped; the others are tried in order: those with enough
+    of their tokens-per-minute budget left for the call first, then those of the tier preferred for
+    the router path the question took, then the freest. When a deployment throttles (429) or fails
+    the call is retried on the next one; members don't retry themselves, so a 429 costs a failover
+    rather than a backoff.
+    """
+
+    members: List[BaseChatModel]
+    states: List[Any]
+    max_tokens: int = 1000
+    streaming: bool = False
+
+    @classmethod
+    def from_deployments(cls, deployments: List[Dict], temperature: float = 0, max_tokens: int = 1000,
+                         streaming: bool = False, **kwargs: Any) -> "LLMPool":
+        members, states = [], []
+        for config in deployments:
+            api_key = config.get("api_key") or os.environ.get(config.get("api_key_env", "AZURE_OPENAI_API_KEY"))
+            members.append(AzureChatOpenAI(
+                deployment_name=config["deployment"],
+                openai_api_base=config.get("endpoint") or os.environ.get("AZURE_OPENAI_ENDPOINT"),
+                openai_api_key=api_key,
+                openai_api_version=config.get("api_version") or os.environ.get("AZURE_OPENAI_API_VERSION"),
+                temperature=temperature, max_tokens=max_tokens, streaming=streaming, max_retries=1, **kwargs))
+            states.append(deployment_state(config))
+        return cls(members=members, states=states, max_tokens=max_tokens, streaming=streaming)
+
+    @property
+    def _llm_type(self) -> str:
+        return "azure-openai-pool"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"deployments": [state.name for state in self.states]}
+
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        return self.members[0]._combine_llm_outputs(llm_outputs)
+
+    def _estimate(self, messages: List[BaseMessage]) -> int:
+        return sum(count_tokens(m.content) for m in messages) + self.max_tokens
+
+    def _order(self, estimate: int) -> List[int]:
+        preferred = PATH_TIERS.get(current_path(), DEFAULT_TIER)
+
+        def rank(i: int):
+            state = self.states[i]
+            headroom = state.headroom()
+            return (headroom < estimate, state.tier != preferred, -headroom / max(state.tpm, 1))
+
+        return sorted((i for i in range(len(self.members)) if self.states[i].available()), key=rank)
+
+    def _used(self, result: ChatResult, messages: List[BaseMessage], estimate: int) -> int:
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        if usage.get("total_tokens"):
+            return usage["total_tokens"]
+        # Streamed responses carry no usage
+        return estimate - self.max_tokens + sum(count_tokens(g.text) for g in result.generations)
+
+    def _failed(self, i: int, error: Exception, estimate: int, streamed: bool) -> bool:
+        """Record the error against the deployment; False if it should not be retried elsewhere.
+
+        Once tokens have been streamed to the callbacks the call is not retried: the caller would
+        get the partial answer followed by a whole second one.
+        """
+        state = self.states[i]
+        if isinstance(error, openai.error.RateLimitError):
+            state.failed(estimate, cooldown=_retry_after(error))
+            reason = "throttled"
+        elif isinstance(error, TRANSIENT_ERRORS):
+            state.failed(estimate)
+            reason = "error"
+        else:
+            state.release(estimate)
+            return False
+        if streamed:
+            return False
+        metrics.inc("llm_pool_failover_total", deployment=state.name, reason=reason)
+        return True
+
+    def _unavailable(self, error: Optional[Exception]) -> Exception:
+        if error is not None:
+            return error
+        return NoDeploymentAvailable("All deployments are throttled or failing: " + ", ".join(s.name for s in self.states))
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        estimate = self._estimate(messages)
+        error = None
+        for i in self._order(estimate):
+            if not self.states[i].begin(estimate):
+                continue
+            watch = _TokenWatch(run_manager) if run_manager else None
+            try:
+                result = self.members[i]._generate(messages, stop=stop, run_manager=watch, **kwargs)
+            except Exception as e:
+                if not self._failed(i, e, estimate, watch is not None and watch.streamed):
+                    raise
+                error = e
+                continue
+            except BaseException:
+                # Cancelled or interrupted: free the reservation, and the probe slot if this was the probe
+                self.states[i].release(estimate)
+                raise
+            self.states[i].succeeded(estimate, self._used(result, messages, estimate))
+            metrics.inc("llm_pool_requests_total", deployment=self.states[i].name)
+            return result
+        raise self._unavailable(error)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        estimate = self._estimate(messages)
+        error = None
+        for i in self._order(estimate):
+            if not self.states[i].begin(estimate):
+                continue
+            watch = _TokenWatch(run_manager) if run_manager else None
+            try:
+                result = await self.members[i]._agenerate(messages, stop=stop, run_manager=watch, **kwargs)
+            except Exception as e:
+                if not self._failed(i, e, estimate, watch is not None and watch.streamed):
+                    raise
+                error = e
+                continue
+            except BaseException:
+                self.states[i].release(estimate)
+                raise
+            self.states[i].succeeded(estimate, self._used(result, messages, estimate))
+            metrics.inc("llm_pool_requests_total", deployment=self.states[i].name)
+            return result
+        raise self._unavailable(error)
+
+
+def build_chat_model(deployment_name: str, temperature: float = 0, max_tokens: int = 1000, streaming: bool = False) -> BaseChatModel:
+    """The chat model to use wherever one is needed: a pool over LLM_DEPLOYMENTS if set, else `deployment_name`"""
+    deployments = load_deployments()
+    if deployments:
+        return LLMPool.from_deployments(deployments, temperature=temperature, max_tokens=max_tokens, streaming=streaming)
+    return AzureChatOpenAI(deployment_name=deployment_name, temperature=temperature, max_tokens=max_tokens, streaming=streaming)
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Per deployment token usage and circuit state, for every deployment used so far"""
+    with _states_lock:
+        states = list(_states.values())
+    return {state.name: state.stats() for state in states}
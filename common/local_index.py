@@ -0,0 +1,272 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from collections import Counter, deque
+from typing import Dict, Iterable, Iterator, List, Tuple
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import numpy as np
+import requests
+
+try:
+    from .extract import extract
+except Exception as e:
+    print(e)
+    from extract import extract
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset("""a an and are as at be been but by can do does for from has have how i if in into is it its
+me my of on or our so that the their them there these they this to was we were what when where which who why
+will with would you your""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens without stopwords and site: restrictions, shared by indexing and querying"""
+    text = re.sub(r"\bsite:\S+", " ", text.lower())
+    return [t for t in TOKEN_RE.findall(text) if t not in STOPWORDS]
+
+
+def chunk_text(text: str, words: int = 120) -> List[str]:
+    """Split text into passages of about `words` words, keeping paragraphs together where possible"""
+    passages, current = [], []
+    for paragraph in text.split("\n"):
+        tokens = paragraph.split()
+        while tokens:
+            room = words - len(current)
+            current.extend(tokens[:room])
+            tokens = tokens[room:]
+            if len(current) >= words:
+                passages.append(" ".join(current))
+                current = []
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+def make_snippet(text: str, terms: Iterable[str], width: int = 300) -> str:
+    """Window of `width` characters around the first query term found in the passage"""
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms if lowered.find(term) >= 0]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    if start:
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < start + 20 else start
+    snippet = text[start:start + width]
+    return ("..." if start else "") + snippet + ("..." if start + width < len(text) else "")
+
+
+class IndexBuilder:
+    """Collects pages, splits them into passages and writes a BM25 index to disk"""
+
+    def __init__(self, passage_words: int = 120):
+        self.passage_words = passage_words
+        self.docs: List[Dict] = []
+        self.term_freqs: List[Counter] = []
+
+    def add(self, link: str, title: str, text: str) -> None:
+        for passage in chunk_text(text, self.passage_words):
+            tokens = tokenize(title + " " + passage)
+            if tokens:
+                self.docs.append({"link": link, "title": title, "text": passage})
+                self.term_freqs.append(Counter(tokens))
+
+    def save(self, path: str) -> None:
+        """Write docs.json, terms.json, meta.json and the postings/doc length arrays to `path`"""
+        os.makedirs(path, exist_ok=True)
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for doc_id, freqs in enumerate(self.term_freqs):
+            for term, tf in freqs.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        terms, doc_ids, tfs, offset = {}, [], [], 0
+        for term in sorted(postings):
+            entries = postings[term]
+            terms[term] = [offset, offset + len(entries)]
+            doc_ids.extend(doc_id for doc_id, _ in entries)
+            tfs.extend(min(tf, 65535) for _, tf in entries)
+            offset += len(entries)
+
+        doc_lens = np.array([sum(freqs.values()) for freqs in self.term_freqs], dtype=np.uint32)
+        np.save(os.path.join(path, "postings_docs.npy"), np.array(doc_ids, dtype=np.uint32))
+        np.save(os.path.join(path, "postings_tfs.npy"), np.array(tfs, dtype=np.uint16))
+        np.save(os.path.join(path, "doc_lens.npy"), doc_lens)
+        with open(os.path.join(path, "terms.json"), "w", encoding="utf-8") as f:
+            json.dump(terms, f)
+        with open(os.path.join(path, "docs.json"), "w", encoding="utf-8") as f:
+            json.dump(self.docs, f, ensure_ascii=False)
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"documents": len(self.docs), "avgdl": float(doc_lens.mean()) if len(doc_lens) else 0.0,
+                       "built": time.time()}, f)
+
+
+class BM25Index:
+    """Read-only BM25 index; postings are memory-mapped so only the terms of a query are paged in"""
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(os.path.join(path, "terms.json"), encoding="utf-8") as f:
+            self.terms: Dict[str, List[int]] = json.load(f)
+        with open(os.path.join(path, "docs.json"), encoding="utf-8") as f:
+            self.docs: List[Dict] = json.load(f)
+        self.doc_ids = np.load(os.path.join(path, "postings_docs.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(path, "postings_tfs.npy"), mmap_mode="r")
+        self.doc_lens = np.load(os.path.join(path, "doc_lens.npy")).astype(np.float32)
+        self.n = meta["documents"]
+        self.avgdl = meta["avgdl"] or 1.0
+        self._norm = self.k1 * (1 - self.b + self.b * self.doc_lens / self.avgdl)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every passage for the query"""
+        scores = np.zeros(self.n, dtype=np.float32)
+        for term in set(tokenize(query)):
+            span = self.terms.get(term)
+            if span is None:
+                continue
+            docs = self.doc_ids[span[0]:span[1]]
+            tf = self.tfs[span[0]:span[1]].astype(np.float32)
+            df = span[1] - span[0]
+            idf = math.log(1 + (self.n - df + 0.5) / (df + 0.5))
+            # Each passage appears at most once per term, so fancy-index accumulation is safe
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + self._norm[docs])
+        return scores
+
+    def search(self, query: str, count: int = 5) -> List[Dict]:
+        """Best passages for the query, one per page, as snippet/title/link dictionaries"""
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > count * 10:
+            candidates = candidates[np.argpartition(-scores[candidates], count * 10)[:count * 10]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        terms = tokenize(query)
+        results, seen = [], set()
+        for doc_id in candidates:
+            doc = self.docs[doc_id]
+            if doc["link"] in seen:
+                continue
+            seen.add(doc["link"])
+            results.append({"snippet": make_snippet(doc["text"], terms), "title": doc["title"], "link": doc["link"]})
+            if len(results) == count:
+                break
+        return results
+
+
+######## CRAWLING #########################################
+###########################################################
+
+def crawl(start_url: str, max_pages: int = 500, delay: float = 0.5, snapshot_dir: str = None) -> Iterator[Tuple[str, str, str]]:
+    """Breadth-first crawl of the start URL's site (HTML pages and linked PDFs), yielding (url, title, text).
+
+    Respects robots.txt and waits `delay` seconds between requests. If `snapshot_dir` is given the
+    raw responses are saved there, so the index can be rebuilt later with `ingest_snapshot`.
+    """
+    host = urlparse(start_url).netloc
+    robots = RobotFileParser(f"{urlparse(start_url).scheme}://{host}/robots.txt")
+    try:
+        robots.read()
+    except Exception as e:
+        print(f"Could not read robots.txt: {e}")
+    session = requests.Session()
+    session.headers["User-Agent"] = "lcc-assistant-indexer/1.0"
+
+    queue, seen, fetched = deque([start_url]), {start_url}, 0
+    while queue and fetched < max_pages:
+        url = queue.popleft()
+        if not robots.can_fetch(session.headers["User-Agent"], url):
+            continue
+        try:
+            response = session.get(url, timeout=15)
+        except requests.RequestException as e:
+            print(f"{url}: {e}")
+            continue
+        fetched += 1
+        content_type = response.headers.get("Content-Type", "")
+        if not response.ok or not ("html" in content_type or "pdf" in content_type):
+            continue
+        if snapshot_dir:
+            _save_snapshot(snapshot_dir, url, content_type, response.content)
+
+        try:
+            title, text, links = extract(response.content, content_type, url)
+        except Exception as e:
+            print(f"{url}: {e}")
+            continue
+        if text:
+            yield url, title, text
+        for link in links:
+            if urlparse(link).netloc == host and link not in seen:
+                seen.add(link)
+                queue.append(link)
+        time.sleep(delay)
+
+
+def _save_snapshot(snapshot_dir: str, url: str, content_type: str, body: bytes) -> None:
+    os.makedirs(snapshot_dir, exist_ok=True)
+    name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    with open(os.path.join(snapshot_dir, name), "wb") as f:
+        f.write(body)
+    with open(os.path.join(snapshot_dir, "manifest.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"url": url, "content_type": content_type, "file": name}) + "\n")
+
+
+def ingest_snapshot(snapshot_dir: str) -> Iterator[Tuple[str, str, str]]:
+    """Pages saved by `crawl`, yielded as (url, title, text) without touching the network"""
+    with open(os.path.join(snapshot_dir, "manifest.jsonl"), encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            with open(os.path.join(snapshot_dir, entry["file"]), "rb") as page:
+                body = page.read()
+            try:
+                title, text, _ = extract(body, entry["content_type"], entry["url"])
+            except Exception as e:
+                print(f"{entry['url']}: {e}")
+                continue
+            if text:
+                yield entry["url"], title, text
+
+
+def build_index(pages: Iterable[Tuple[str, str, str]], path: str) -> int:
+    builder = IndexBuilder()
+    for url, title, text in pages:
+        builder.add(url, title, text)
+    builder.save(path)
+    return len(builder.docs)
+
+
+###
+# Build the local index of the council website:
+#   python -m common.local_index crawl --max-pages 2000 --snapshot .index/snapshot
+#   python -m common.local_index snapshot .index/snapshot      (rebuild from a saved snapshot)
+#   python -m common.local_index search "dropped kerb cost"
+###
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local BM25 index of the council website")
+    parser.add_argument("--index", default=os.environ.get("LOCAL_INDEX_PATH", ".index/leicestershire"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    crawl_parser = commands.add_parser("crawl")
+    crawl_parser.add_argument("--start", default="https://www.leicestershire.gov.uk/")
+    crawl_parser.add_argument("--max-pages", type=int, default=500)
+    crawl_parser.add_argument("--delay", type=float, default=0.5)
+    crawl_parser.add_argument("--snapshot", default=None, help="directory to save the raw pages to")
+    snapshot_parser = commands.add_parser("snapshot")
+    snapshot_parser.add_argument("directory")
+    search_parser = commands.add_parser("search")
+    search_parser.add_argument("query")
+    args = parser.parse_args()
+
+    if args.command == "crawl":
+        print(build_index(crawl(args.start, args.max_pages, args.delay, args.snapshot), args.index), "passages indexed")
+    elif args.command == "snapshot":
+        print(build_index(ingest_snapshot(args.directory), args.index), "passages indexed")
+    else:
+        for result in BM25Index(args.index).search(args.query):
+            print(json.dumps(result, ensure_ascii=False))
@@ -0,0 +1,244 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+try:
+    from .context import compact_results, count_tokens, _truncate
+    from .llm_pool import build_chat_model
+    from .local_index import tokenize
+    from .prompts import SUMMARY_PROMPT_TEMPLATE
+except Exception as e:
+    print(e)
+    from context import compact_results, count_tokens, _truncate
+    from llm_pool import build_chat_model
+    from local_index import tokenize
+    from prompts import SUMMARY_PROMPT_TEMPLATE
+
+MEMORY_MAX_SESSIONS = int(os.environ.get("MEMORY_MAX_SESSIONS", 1000))
+MEMORY_SESSION_TTL = float(os.environ.get("MEMORY_SESSION_TTL", 3600))
+# Tokens of conversation history placed in a prompt: the rolling summary plus the latest turns
+MEMORY_HISTORY_TOKENS = int(os.environ.get("MEMORY_HISTORY_TOKENS", 800))
+
+# Follow-ups open with a connective ("and how much does that cost?", "what about for businesses?") or
+# a pronoun, possibly after a verb ("it's free?", "is it open on Sundays?"). A pronoun further in
+# doesn't make one: "Is there a charge for garden waste collection?" is a question of its own.
+FOLLOW_UP_START_RE = re.compile(r"^\s*(and|also|so|but|then|what about|how about|ok|okay)\b", re.IGNORECASE)
+PRONOUN_START_RE = re.compile(r"^\s*((is|are|was|were|does|do|did|can|will|would|should|has|have)\s+)?"
+                              r"(it|it's|its|that|that's|this|those|these|they|they're|them|their|he|she)\b", re.IGNORECASE)
+FOLLOW_UP_MAX_WORDS = 12
+# Words that don't change what a follow-up is about
+FILLER_TERMS = frozenset("about also much many long one same please ok okay then".split())
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+
+Summarizer = Callable[[str, str, str, int], str]
+
+
+def standalone_query(question: str, previous: str, max_terms: int = 5) -> str:
+    """The question with the key terms of the previous one added, unless it names its own topic"""
+    asked = set(tokenize(question)) - FILLER_TERMS
+    # "what about adult social care?" names its own topic, "is it free?" needs the previous one
+    if len(asked) > 1:
+        return question
+    extra = [t for t in dict.fromkeys(tokenize(previous)) if t not in asked and t not in FILLER_TERMS][:max_terms]
+    return " ".join([question.strip()] + extra)
+
+
+def extractive_summary(summary: str, question: str, answer: str, max_tokens: int) -> str:
+    """Append the question and the answer's first sentence, dropping the oldest exchanges over budget"""
+    entries = [e for e in summary.split("\n") if e]
+    first_sentence = SENTENCE_END_RE.split(answer.strip(), 1)[0]
+    entries.append(f"- Asked: {question.strip()} Answered: {first_sentence}")
+    while len(entries) > 1 and count_tokens("\n".join(entries)) > max_tokens:
+        entries.pop(0)
+    return _truncate("\n".join(entries), max_tokens, "gpt-3.5-turbo")
+
+
+def llm_summarizer(llm) -> Summarizer:
+    """Summarizer rewriting the summary with the LLM (one extra call each time a turn rolls into it)"""
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
+
+    chain = LLMChain(llm=llm, prompt=PromptTemplate.from_template(SUMMARY_PROMPT_TEMPLATE))
+
+    def summarize(summary: str, question: str, answer: str, max_tokens: int) -> str:
+        exchange = f"Resident: {question}\nAssistant: {answer}"
+        text = chain.run(summary=summary or "(none)", exchange=exchange, max_words=max_tokens * 3 // 4)
+        return _truncate(text.strip(), max_tokens, "gpt-3.5-turbo")
+
+    return summarize
+
+
+class Session:
+    def __init__(self):
+        self.summary = ""
+        self.turns: Deque[Tuple[str, str]] = deque()
+        self.results: List[Dict] = []
+        self.terms: set = set()
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        # Held while turns are folded into the summary, which may take an LLM call; never inside `lock`
+        self.summary_lock = threading.Lock()
+
+
+class ConversationMemory:
+    """Per-session conversation history with a constant prompt footprint.
+
+    Sessions live in an LRU map (at most `max_sessions`, dropped after `ttl` seconds idle). Each
+    keeps its latest turns verbatim and folds older ones into a rolling summary, so the history
+    rendered for a prompt never exceeds `history_tokens`. The last search results are kept too,
+    compacted, so follow-up questions about the same topic can be answered without searching again.
+    """
+
+    def __init__(self, max_sessions: int = MEMORY_MAX_SESSIONS, ttl: float = MEMORY_SESSION_TTL,
+                 history_tokens: int = MEMORY_HISTORY_TOKENS, summarizer: Optional[Summarizer] = None,
+                 max_new_terms: int = 1):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.history_tokens = history_tokens
+        self.summary_tokens = history_tokens // 3
+        self.summarizer = summarizer or extractive_summary
+        self.max_new_terms = max_new_terms
+        self.reused = 0
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _session(self, session_id: str, create: bool = False) -> Optional[Session]:
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and now - session.last_used > self.ttl:
+                del self._sessions[session_id]
+                session = None
+            if session is None:
+                if not create:
+                    return None
+                session = self._sessions[session_id] = Session()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            session.last_used = now
+            return session
+
+    def is_follow_up(self, session_id: str, question: str) -> bool:
+        """Whether the question only makes sense after the previous turn ("and how much is it?")"""
+        session = self._session(session_id)
+        if session is None or not session.turns and not session.summary:
+            return False
+        if len(question.split()) > FOLLOW_UP_MAX_WORDS:
+            return False
+        return bool(FOLLOW_UP_START_RE.search(question) or PRONOUN_START_RE.search(question))
+
+    def reusable_results(self, session_id: str, question: str) -> Optional[List[Dict]]:
+        """The previous turn's search results if the follow-up adds at most `max_new_terms` new terms to it"""
+        if not self.is_follow_up(session_id, question):
+            return None
+        session = self._session(session_id)
+        with session.lock:
+            if not session.results:
+                return None
+            new_terms = set(tokenize(question)) - FILLER_TERMS - session.terms
+            if len(new_terms) > self.max_new_terms:
+                return None
+            self.reused += 1
+            return list(session.results)
+
+    def search_query(self, session_id: str, question: str) -> str:
+        """Query to search for: a follow-up gets the previous question's key terms added so it stands on its own"""
+        if not self.is_follow_up(session_id, question):
+            return question
+        session = self._session(session_id)
+        with session.lock:
+            previous = session.turns[-1][0] if session.turns else ""
+        return standalone_query(question, previous)
+
+    def history(self, session_id: str) -> str:
+        """Summary of the earlier conversation and the latest turns, within the history token budget"""
+        session = self._session(session_id)
+        if session is None:
+            return ""
+        with session.lock:
+            return self._render(session)
+
+    def add_turn(self, session_id: str, question: str, answer: str, results: Optional[List[Dict]] = None) -> None:
+        """Record an answered question; `results` are the search results it was answered from, if any"""
+        session, rolled = self._record(session_id, question, answer, results)
+        if rolled:
+            self._summarize(session, rolled)
+
+    async def aadd_turn(self, session_id: str, question: str, answer: str, results: Optional[List[Dict]] = None) -> None:
+        """Async version of add_turn, summarizing in a worker thread so the event loop isn't blocked"""
+        session, rolled = self._record(session_id, question, answer, results)
+        if rolled:
+            await asyncio.to_thread(self._summarize, session, rolled)
+
+    def _record(self, session_id: str, question: str, answer: str,
+                results: Optional[List[Dict]]) -> Tuple[Session, List[Tuple[str, str]]]:
+        """Add the turn to the session; returns the older turns that no longer fit, to be summarized"""
+        session = self._session(session_id, create=True)
+        turn_tokens = self.history_tokens - self.summary_tokens
+        rolled = []
+        with session.lock:
+            session.turns.append((question, _truncate(answer, turn_tokens // 2, "gpt-3.5-turbo")))
+            if results:
+                session.results = compact_results(results)
+                # What the results are about: the question and their titles (snippets mention too much)
+                session.terms = set(tokenize(question + " " + " ".join(r.get("title", "") for r in session.results)))
+            while len(session.turns) > 1 and count_tokens(self._render_turns(session)) > turn_tokens:
+                rolled.append(session.turns.popleft())
+        return session, rolled
+
+    def _summarize(self, session: Session, rolled: List[Tuple[str, str]]) -> None:
+        """Fold turns into the session summary without holding `session.lock` during the summarizer call"""
+        with session.summary_lock:
+            with session.lock:
+                summary = session.summary
+            for old_question, old_answer in rolled:
+                summary = self.summarizer(summary, old_question, old_answer, self.summary_tokens)
+            with session.lock:
+                session.summary = summary
+
+    def clear(self, session_id: Optional[str] = None) -> None:
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"sessions": len(self._sessions), "reused_results": self.reused}
+
+    def _render_turns(self, session: Session) -> str:
+        return "\n".join(f"Resident: {q}\nAssistant: {a}" for q, a in session.turns)
+
+    def _render(self, session: Session) -> str:
+        parts = []
+        if session.summary:
+            parts.append("Earlier in the conversation:\n" + session.summary)
+        if session.turns:
+            parts.append(self._render_turns(session))
+        return "\n\n".join(parts)
+
+
+_memory: Optional[ConversationMemory] = None
+_memory_lock = threading.Lock()
+
+
+def get_memory() -> ConversationMemory:
+    """Conversation memory shared by the pipelines, configured by the MEMORY_* settings.
+
+    With MEMORY_LLM_SUMMARY=true older turns are summarized by the MEMORY_SUMMARY_DEPLOYMENT model
+    instead of being shortened to their first sentence.
+    """
+    global _memory
+    with _memory_lock:
+        if _memory is None:
+            summarizer = None
+            if os.environ.get("MEMORY_LLM_SUMMARY", "false").lower() == "true":
+                llm = build_chat_model(os.environ.get("MEMORY_SUMMARY_DEPLOYMENT", "gpt-35-turbo"), max_tokens=MEMORY_HISTORY_TOKENS // 3)
+                summarizer = llm_summarizer(llm)
+            _memory = ConversationMemory(summarizer=summarizer)
+        return _memory
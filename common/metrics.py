@@ -0,0 +1,183 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Set METRICS_ENABLED=true to record spans; when off every hook below is a no-op
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+TRACE_PATH = os.environ.get("TRACE_PATH", ".cache/traces.jsonl")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """Process wide histograms and counters, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {histogram.total}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+REGISTRY = Registry()
+
+# Spans of the request being handled in this thread/task, and the entry point it came in through
+_current_trace: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar("current_trace", default=None)
+_trace_lock = threading.Lock()
+_NOOP = nullcontext()
+
+
+def current_trace() -> Optional[Dict]:
+    return _current_trace.get()
+
+
+def current_entry_point() -> str:
+    trace = _current_trace.get()
+    return trace["entry_point"] if trace else "unknown"
+
+
+def record_span(stage: str, start: float, duration: float, trace: Optional[Dict] = None, **attributes) -> None:
+    """Add a finished span to the trace (the current one by default) and the stage latency histogram"""
+    if not METRICS_ENABLED:
+        return
+    trace = trace or _current_trace.get()
+    entry_point = trace["entry_point"] if trace else "unknown"
+    REGISTRY.observe("pipeline_stage_seconds", duration, stage=stage, entry_point=entry_point)
+    if trace is not None:
+        trace["spans"].append({"stage": stage, "start": round(start - trace["start"], 6), "duration": round(duration, 6), **attributes})
+
+
+@contextmanager
+def _span(stage: str, attributes: Dict) -> Iterator[Dict]:
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        record_span(stage, start, time.perf_counter() - start, **attributes)
+
+
+def span(stage: str, **attributes):
+    """Time a pipeline stage (search, fetch, llm, ...) of the current request"""
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _span(stage, attributes)
+
+
+@contextmanager
+def _trace(entry_point: str, attributes: Dict) -> Iterator[Dict]:
+    trace = {"entry_point": entry_point, "start": time.perf_counter(), "timestamp": time.time(), "spans": [], **attributes}
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        duration = time.perf_counter() - trace.pop("start")
+        trace["duration"] = round(duration, 6)
+        REGISTRY.observe("request_seconds", duration, entry_point=entry_point)
+        _write_trace(trace)
+
+
+def trace(entry_point: str, **attributes):
+    """Trace one request through an entry point; nested entry points become spans of the outer request"""
+    if not METRICS_ENABLED:
+        return _NOOP
+    if _current_trace.get() is not None:
+        return _span(entry_point, attributes)
+    return _trace(entry_point, attributes)
+
+
+def _write_trace(trace: Dict) -> None:
+    if not TRACE_PATH:
+        return
+    line = json.dumps(trace, default=str) + "\n"
+    with _trace_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(TRACE_PATH)), exist_ok=True)
+        with open(TRACE_PATH, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def inc(name: str, value: float = 1, entry_point: Optional[str] = None, **labels: str) -> None:
+    if METRICS_ENABLED:
+        REGISTRY.inc(name, value, entry_point=entry_point or current_entry_point(), **labels)
+
+
+def observe(name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, entry_point: Optional[str] = None, **labels: str) -> None:
+    if METRICS_ENABLED:
+        REGISTRY.observe(name, value, buckets, entry_point=entry_point or current_entry_point(), **labels)
+
+
+def callbacks() -> List:
+    """Callback handlers to add to a chain/agent run so LLM calls, tools and agent steps are recorded.
+
+    Call it inside the request's trace: the handler keeps a reference to it, because langchain may
+    run sync handlers of async chains on executor threads that don't see the trace context.
+    """
+    if not METRICS_ENABLED:
+        return []
+    try:
+        from .callbacks import MetricsCallbackHandler
+    except Exception:
+        from callbacks import MetricsCallbackHandler
+    return [MetricsCallbackHandler()]
+
+
+def render_prometheus() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Tuple
+
+
+class ExecutorPool:
+    """Thread-safe pool of reusable objects (agent executors, tools), built once per configuration.
+
+    Objects are checked out exclusively, so an executor is never shared by two runs at once.
+    When every object for a configuration is busy a new one is built; when it is released it
+    joins the free list and is reused by the next caller. At most `max_configurations` are kept:
+    the least recently used one is dropped, with its idle objects and pins, to make room for a new one.
+    """
+
+    def __init__(self, max_idle: int = 32, max_configurations: int = 64):
+        self.max_idle = max_idle
+        self.max_configurations = max_configurations
+        self.built = 0
+        self.reused = 0
+        self.evicted = 0
+        # key -> (free objects, pinned objects)
+        self._configurations: "OrderedDict[Hashable, Tuple[List[Any], Tuple]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _configuration(self, key: Hashable, pin: Tuple) -> Tuple[List[Any], Tuple]:
+        configuration = self._configurations.get(key)
+        if configuration is None:
+            configuration = self._configurations[key] = ([], pin)
+            while len(self._configurations) > self.max_configurations:
+                self._configurations.popitem(last=False)
+                self.evicted += 1
+        self._configurations.move_to_end(key)
+        return configuration
+
+    @contextmanager
+    def acquire(self, key: Hashable, build: Callable[[], Any], pin: Tuple = ()) -> Iterator[Any]:
+        """Check out an object for `key`, building it with `build` if none is idle.
+
+        `pin` keeps the objects whose id() is part of the key alive while the configuration is
+        pooled, so the key cannot be reused by another object.
+        """
+        with self._lock:
+            free, _ = self._configuration(key, pin)
+            item = free.pop() if free else None
+        if item is None:
+            item = build()
+            self.built += 1
+        else:
+            self.reused += 1
+        try:
+            yield item
+        finally:
+            with self._lock:
+                # The configuration may have been evicted while the object was checked out; then it is dropped
+                configuration = self._configurations.get(key)
+                if configuration is not None and len(configuration[0]) < self.max_idle:
+                    configuration[0].append(item)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._configurations.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"built": self.built, "reused": self.reused, "configurations": len(self._configurations), "evicted": self.evicted}
+
+
+# Shared by every BingSearchTool in the process
+EXECUTOR_POOL = ExecutorPool()
@@ -120,13 +120,10 @@ BING_PROMPT_PREFIX = CUSTOM_CHATBOT_PREFIX + """
 Question: Who is the current president of the United States?
 
 Context: 
-[{{'snippet': 'U.S. facts and figures Presidents,<b></b> vice presidents,<b></b> and first ladies Presidents,<b></b> vice presidents,<b></b> and first ladies Learn about the duties of <b>president</b>, vice <b>president</b>, and first lady <b>of the United</b> <b>States</b>. Find out how to contact and learn more about <b>current</b> and past leaders. <b>President</b> <b>of the United</b> <b>States</b> Vice <b>president</b> <b>of the United</b> <b>States</b>',
+[{{'snippet': 'Learn about the duties of president, vice president, and first lady of the United States.',
   'title': 'Presidents, vice presidents, and first ladies | USAGov',
   'link': 'https://www.usa.gov/presidents'}},
- {{'snippet': 'The 1st <b>President</b> <b>of the United</b> <b>States</b> John Adams The 2nd <b>President</b> <b>of the United</b> <b>States</b> Thomas Jefferson The 3rd <b>President</b> <b>of the United</b> <b>States</b> James Madison The 4th <b>President</b>...',
-  'title': 'Presidents | The White House',
-  'link': 'https://www.whitehouse.gov/about-the-white-house/presidents/'}},
- {{'snippet': 'Download Official Portrait <b>President</b> Biden represented Delaware for 36 years in the U.S. Senate before becoming the 47th Vice <b>President</b> <b>of the United</b> <b>States</b>. As <b>President</b>, Biden will...',
+ {{'snippet': 'President Biden represented Delaware for 36 years in the U.S. Senate before becoming the 47th Vice President of the United States.',
   'title': 'Joe Biden: The President | The White House',
   'link': 'https://www.whitehouse.gov/administration/president-biden/'}}]
 
@@ -135,4 +132,15 @@ Final Answer: The incumbent president of the United States is **Joe Biden**. <su
 
 ## You have access to the following tools:
 
-"""
\ No newline at end of file
+"""
+
+SUMMARY_PROMPT_TEMPLATE = """Progressively summarize the conversation between a resident and the Leicestershire County Council assistant, adding the new exchange to the current summary.
+Keep the services, places, dates and amounts that were discussed. Write at most {max_words} words and return the new summary only.
+
+Current summary:
+{summary}
+
+New exchange:
+{exchange}
+
+New summary:"""
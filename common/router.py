@@ -0,0 +1,130 @@
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    from . import metrics
+except Exception as e:
+    print(e)
+    import metrics
+
+SIMPLE = "simple"
+COMPOUND = "compound"
+
+QUESTION_WORDS = r"(how|what|when|where|who|whom|which|why|can|could|do|does|did|is|are|will|would|should|much|many)"
+# "... and how much does it cost", "... also what ...", "..., plus when ..."
+JOINED_QUESTION_RE = re.compile(r"\b(and|also|as well as|plus|then)\s+(also\s+)?" + QUESTION_WORDS + r"\b", re.IGNORECASE)
+COMPARISON_RE = re.compile(r"\b(compare|comparison|difference between|differences between|versus|vs\.?)\b", re.IGNORECASE)
+# Sentences end at ".", "?" or "!" followed by whitespace, so "1.5 tonnes" or "gov.uk" stay whole
+SENTENCE_BREAK_RE = re.compile(r"(?<=[.?!])\s+")
+# Follow-ups often open with a connective ("and how much is it?"), which doesn't make them compound
+LEADING_CONNECTIVE_RE = re.compile(r"^\s*(and|also|plus|then)\s+", re.IGNORECASE)
+MAX_SIMPLE_WORDS = 30
+
+# Pipeline answering compound questions: "search" splits them into concurrent searches answered by one
+# LLM call (using_bing_search), "agent" has the ReAct agent search for each part in turn
+COMPOUND_PIPELINE = os.environ.get("COMPOUND_PIPELINE", "search")
+
+# Path of the question being answered, so the work it does (e.g. picking an LLM deployment) can depend on it
+ROUTED_PATH: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("routed_path", default=None)
+
+
+def asking_sentences(text: str) -> List[str]:
+    """The sentences of the text that ask something (end with "?" or open with a question word)"""
+    sentences = [s.strip() for s in SENTENCE_BREAK_RE.split(text) if s.strip()]
+    return [s for s in sentences if s.endswith("?") or re.match(QUESTION_WORDS + r"\b", s, re.IGNORECASE)]
+
+
+def classify(question: str) -> str:
+    """Cheaply tell single-intent questions from compound ones, without calling an LLM.
+
+    A question is compound if it asks more than one question (several question marks or
+    interrogative sentences, or a second question joined with "and how/what/..."), compares
+    things, or is long enough that it is unlikely to be a single lookup.
+    """
+    text = LEADING_CONNECTIVE_RE.sub("", question.strip())
+    if text.count("?") > 1:
+        return COMPOUND
+    if len(asking_sentences(text)) > 1:
+        return COMPOUND
+    if JOINED_QUESTION_RE.search(text) or COMPARISON_RE.search(text):
+        return COMPOUND
+    if len(text.split()) > MAX_SIMPLE_WORDS:
+        return COMPOUND
+    return SIMPLE
+
+
+def current_path() -> Optional[str]:
+    return ROUTED_PATH.get()
+
+
+@contextmanager
+def routed(path: str) -> Iterator[None]:
+    """Mark the code run inside as answering a question routed down `path`"""
+    token = ROUTED_PATH.set(path)
+    try:
+        yield
+    finally:
+        ROUTED_PATH.reset(token)
+
+
+class QuestionRouter:
+    """Send simple questions down the single-call search pipeline and compound ones to the agent.
+
+    Every routed question is recorded with the path taken and its latency; `stats()` summarizes them.
+    """
+
+    def __init__(self, simple: Callable[[str], Any], compound: Callable[[str], Any], history: int = 1000):
+        self.handlers = {SIMPLE: simple, COMPOUND: compound}
+        self.history = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def classify(self, question: str) -> str:
+        """Path for the question, counted in the metrics and the current trace"""
+        path = classify(question)
+        trace = metrics.current_trace()
+        if trace is not None:
+            trace["path"] = path
+        metrics.inc("router_path_total", path=path)
+        return path
+
+    def record(self, question: str, path: str, started: float) -> Dict:
+        """Add a question answered outside route/aroute (e.g. streamed) to the stats"""
+        record = {"question": question, "path": path, "latency": time.perf_counter() - started}
+        with self._lock:
+            self.history.append(record)
+        metrics.observe("router_path_seconds", record["latency"], path=path)
+        return record
+
+    def route(self, question: str, **kwargs) -> Dict:
+        """Answer the question on the path chosen for it, returning {'path', 'latency', 'result'}.
+
+        Keyword arguments (e.g. session_id) are passed on to the handler.
+        """
+        started = time.perf_counter()
+        path = self.classify(question)
+        with routed(path):
+            result = self.handlers[path](question, **kwargs)
+        return {**self.record(question, path, started), "result": result}
+
+    async def aroute(self, question: str, **kwargs) -> Dict:
+        """Async version of route; the handlers must be coroutine functions"""
+        started = time.perf_counter()
+        path = self.classify(question)
+        with routed(path):
+            result = await self.handlers[path](question, **kwargs)
+        return {**self.record(question, path, started), "result": result}
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            records = list(self.history)
+        summary = {}
+        for path in self.handlers:
+            latencies = [r["latency"] for r in records if r["path"] == path]
+            summary[path] = {"count": len(latencies), "mean_latency": sum(latencies) / len(latencies) if latencies else 0.0}
+        return summary
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import threading
+from typing import Dict, List, Optional
+
+try:
+    from . import bing
+    from .cache import get_search_cache, make_key
+    from .local_index import BM25Index
+except Exception as e:
+    print(e)
+    import bing
+    from cache import get_search_cache, make_key
+    from local_index import BM25Index
+
+
+class SearchBackend:
+    """Interface of the search backends behind the Bing tools and get_bing_results.
+
+    `results` returns a list of {'snippet', 'title', 'link'} dictionaries, the shape the prompts expect.
+    """
+
+    name = "base"
+
+    def results(self, query: str, num_results: int) -> List[Dict]:
+        raise NotImplementedError
+
+    async def aresults(self, query: str, num_results: int) -> List[Dict]:
+        return await asyncio.to_thread(self.results, query, num_results)
+
+
+class BingBackend(SearchBackend):
+    """Live Bing v7 search through the shared client, cached by the shared search cache"""
+
+    name = "bing"
+
+    def results(self, query: str, num_results: int) -> List[Dict]:
+        cache = get_search_cache()
+        key = make_key(query, count=num_results)
+        results = cache.get(key)
+        if results is None:
+            results = bing.results(query, num_results=num_results)
+            cache.set(key, results)
+        return results
+
+    async def aresults(self, query: str, num_results: int) -> List[Dict]:
+        cache = get_search_cache()
+        key = make_key(query, count=num_results)
+        results = cache.get(key)
+        if results is None:
+            results = await bing.aresults(query, num_results=num_results)
+            cache.set(key, results)
+        return results
+
+
+class LocalIndexBackend(SearchBackend):
+    """Offline BM25 index of the council website, built with `python -m common.local_index`"""
+
+    name = "local"
+
+    def __init__(self, path: str):
+        self.index = BM25Index(path)
+
+    def results(self, query: str, num_results: int) -> List[Dict]:
+        results = self.index.search(query, count=num_results)
+        return results or [{"Result": "No good Bing Search Result was found"}]
+
+    async def aresults(self, query: str, num_results: int) -> List[Dict]:
+        # In-memory scoring takes milliseconds, not worth a thread hop
+        return self.results(query, num_results)
+
+
+def as_web_pages(results: List[Dict]) -> Dict:
+    """Wrap backend results in the Bing v7 response shape used by get_bing_results"""
+    values = [{"name": r["title"], "url": r["link"], "snippet": r["snippet"]} for r in results if "link" in r]
+    return {"webPages": {"value": values}} if values else {}
+
+
+_backend: Optional[SearchBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_search_backend() -> SearchBackend:
+    """Backend selected by SEARCH_BACKEND ("bing", the default, or "local" with LOCAL_INDEX_PATH)"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if os.environ.get("SEARCH_BACKEND", "bing").lower() == "local":
+                _backend = LocalIndexBackend(os.environ.get("LOCAL_INDEX_PATH", ".index/leicestershire"))
+            else:
+                _backend = BingBackend()
+        return _backend
+
+
+def set_search_backend(backend: SearchBackend) -> None:
+    global _backend
+    with _backend_lock:
+        _backend = backend
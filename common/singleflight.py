@@ -0,0 +1,196 @@
+import asyncio
+import contextvars
+import os
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional
+
+try:
+    from .cache import normalize_query
+    from . import metrics
+except Exception as e:
+    print(e)
+    from cache import normalize_query
+    import metrics
+
+# Set COALESCE_REQUESTS=false to give every request its own search and LLM calls
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "true").lower() == "true"
+
+
+def question_key(kind: str, question: str, *config: Hashable) -> Hashable:
+    """Key under which identical questions for the same pipeline and configuration are coalesced"""
+    return (kind, normalize_query(question), config)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class _Stream:
+    """Items produced so far by a shared stream; subscribers replay them, then wait for more"""
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.condition = threading.Condition()
+
+    def push(self, item: Any) -> None:
+        with self.condition:
+            self.items.append(item)
+            self.condition.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+
+class _AsyncStream:
+    """Async counterpart of _Stream, for subscribers on one event loop"""
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.wakeup = asyncio.Event()
+        self.producer: Optional[asyncio.Task] = None
+
+
+class SingleFlight:
+    """Runs concurrent calls with the same key once and hands every caller the same outcome.
+
+    The first caller for a key (the leader) does the work; callers arriving while it is in flight
+    wait for its result, or its exception, instead of starting their own. Streams are fanned out:
+    the producer runs in its own thread/task and every subscriber gets all items from the start.
+    Nothing is kept once a call completes, later callers start a new one (caches handle reuse).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+        self._streams: Dict[Hashable, _Stream] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, flights: Dict, key: Hashable, create: Callable[[], Any]):
+        """(flight, is_leader) for the key, registering a new flight if none is in progress"""
+        with self._lock:
+            flight = flights.get(key)
+            if flight is not None:
+                self.shared += 1
+                metrics.inc("singleflight_shared_total")
+                return flight, False
+            flight = flights[key] = create()
+            self.calls += 1
+            return flight, True
+
+    def _leave(self, flights: Dict, key: Hashable, flight: Any) -> None:
+        with self._lock:
+            if flights.get(key) is flight:
+                del flights[key]
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Return fn(), sharing one call among the threads asking for the same key at once"""
+        call, leader = self._join(self._calls, key, _Call)
+        if not leader:
+            with metrics.span("singleflight_wait"):
+                call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                self._leave(self._calls, key, call)
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Async version of do; the shared call keeps running if one of its callers is cancelled"""
+        loop = asyncio.get_running_loop()
+        task, leader = self._join(self._tasks, (id(loop), key), lambda: loop.create_task(fn()))
+        if leader:
+            task.add_done_callback(lambda _: self._leave(self._tasks, (id(loop), key), task))
+            return await asyncio.shield(task)
+        with metrics.span("singleflight_wait"):
+            return await asyncio.shield(task)
+
+    def stream(self, key: Hashable, run: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """Yield the items of run(), one producer thread per key feeding every caller"""
+        shared, leader = self._join(self._streams, key, _Stream)
+        if leader:
+            def produce():
+                try:
+                    for item in run():
+                        shared.push(item)
+                    error = None
+                except BaseException as e:
+                    error = e
+                self._leave(self._streams, key, shared)
+                shared.finish(error)
+
+            threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+        return self._subscribe(shared)
+
+    def _subscribe(self, shared: _Stream) -> Iterator[Any]:
+        position = 0
+        while True:
+            with shared.condition:
+                while position == len(shared.items) and not shared.finished:
+                    shared.condition.wait()
+                items = shared.items[position:]
+                finished, error = shared.finished, shared.error
+            yield from items
+            position += len(items)
+            if finished and position == len(shared.items):
+                if error is not None:
+                    raise error
+                return
+
+    async def astream(self, key: Hashable, run: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Async version of stream; the producer is a task on the running loop"""
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        shared, leader = self._join(self._streams, flight_key, _AsyncStream)
+        if leader:
+            async def produce():
+                error = None
+                try:
+                    async for item in run():
+                        shared.items.append(item)
+                        shared.wakeup.set()
+                except BaseException as e:
+                    error = e
+                self._leave(self._streams, flight_key, shared)
+                shared.finished, shared.error = True, error
+                shared.wakeup.set()
+
+            shared.producer = loop.create_task(produce())
+
+        position = 0
+        while True:
+            while position == len(shared.items) and not shared.finished:
+                shared.wakeup.clear()
+                await shared.wakeup.wait()
+            items = shared.items[position:]
+            for item in items:
+                yield item
+            position += len(items)
+            if shared.finished and position == len(shared.items):
+                if shared.error is not None:
+                    raise shared.error
+                return
+
+    def stats(self) -> Dict[str, int]:
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._calls) + len(self._tasks) + len(self._streams)}
+
+
+# Shared by every pipeline in the process
+SINGLE_FLIGHT = SingleFlight()
@@ -1,38 +1,337 @@
-from typing import Dict, Union
+import asyncio
+import contextvars
+import json
+import os
+import queue
+import re
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Union
 
-from langchain.chat_models import AzureChatOpenAI
+from langchain.chat_models.base import BaseChatModel
 from langchain.schema import OutputParserException
 from langchain.chains import LLMChain
 from langchain.tools import BaseTool
 from langchain.prompts import PromptTemplate
 from langchain.agents import AgentExecutor, initialize_agent, AgentType
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.tools import BaseTool
-from langchain.utilities import BingSearchAPIWrapper
 
 try:
     from .prompts import (BING_PROMPT_PREFIX)
+    from .search import get_search_backend
+    from .pool import EXECUTOR_POOL
+    from .docsearch import DocSearchTool
+    from .callbacks import AsyncQueueCallbackHandler, QueueCallbackHandler
+    from .context import compact_results
+    from .fetch import FETCH_PAGES, enrich_results
+    from . import metrics
+    from .singleflight import COALESCE_REQUESTS, SINGLE_FLIGHT, question_key
+    from .memory import get_memory
 except Exception as e:
     print(e)
     from prompts import (BING_PROMPT_PREFIX)
+    from search import get_search_backend
+    from pool import EXECUTOR_POOL
+    from docsearch import DocSearchTool
+    from callbacks import AsyncQueueCallbackHandler, QueueCallbackHandler
+    from context import compact_results
+    from fetch import FETCH_PAGES, enrich_results
+    import metrics
+    from singleflight import COALESCE_REQUESTS, SINGLE_FLIGHT, question_key
+    from memory import get_memory
 
+# Maximum number of agent runs in flight at once from a single event loop
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 20))
+_llm_semaphore = None
 
-def run_agent(question:str, agent_chain: AgentExecutor) -> str:
-    """Function to run the brain agent and deal with potential parsing errors"""
-    
+
+# How often OutputParserException recovery could be done locally vs needed another LLM call
+PARSER_RECOVERY = {"local": 0, "llm_fallback": 0}
+_recovery_lock = threading.Lock()
+
+PARSE_ERROR_PREFIX_RE = re.compile(r"^\s*(Could not parse LLM output:|Parsing LLM output produced both a final answer and a parse-able action:)\s*", re.IGNORECASE)
+JSON_BLOCK_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```|(\{.*\})", re.DOTALL)
+ACTION_RE = re.compile(r"^\s*Action\s*\d*\s*:", re.MULTILINE)
+# "I now know the final answer.", "I should search ...": how the thought of a ReAct step reads
+THOUGHT_RE = re.compile(r"^\s*(Thought\s*:\s*)?(I|I'm|Let me|Now|Based on|According to)\b.*?[.!:](\s+|$)", re.IGNORECASE)
+
+
+def extract_answer(llm_output: str) -> Optional[str]:
+    """Recover the answer from an output the agent could not parse, without calling an LLM.
+
+    Strips the "Could not parse LLM output:" prefix and code fences, unwraps JSON blobs
+    ({"action": "Final Answer", "action_input": ...} and similar) and keeps the text after
+    "Final Answer:". Returns None when the output is a tool call or holds no usable text.
+    """
+    text = PARSE_ERROR_PREFIX_RE.sub("", str(llm_output or "")).strip().strip("`").strip()
+    blob = None
+
+    match = JSON_BLOCK_RE.search(text)
+    if match:
+        try:
+            blob = json.loads(match.group(1) or match.group(2))
+        except json.JSONDecodeError:
+            blob = None
+        if isinstance(blob, dict):
+            if "action" in blob and blob["action"] != "Final Answer":
+                return None
+            for key in ("action_input", "answer", "output", "text", "response"):
+                if isinstance(blob.get(key), str):
+                    text = blob[key]
+                    break
+
+    if "Final Answer:" in text:
+        text = text.rsplit("Final Answer:", 1)[1]
+    elif ACTION_RE.search(text):
+        return None
+    elif not isinstance(blob, dict):
+        text = _drop_thought(text)
+    text = re.sub(r"^\s*Thought\s*:.*$", "", text, flags=re.MULTILINE).strip()
+    return text or None
+
+
+def _drop_thought(text: str) -> str:
+    """Drop the thought a ReAct completion opens with; it follows "Thought:" in the prompt, so it has no label.
+
+    Text that doesn't open with a thought is the answer itself and is kept whole.
+    """
+    match = THOUGHT_RE.match(text)
+    return text[match.end():] if match else text
+
+
+def _count_recovery(kind: str) -> None:
+    with _recovery_lock:
+        PARSER_RECOVERY[kind] += 1
+    metrics.inc("parser_recovery_total", kind=kind)
+
+
+def parser_recovery_stats() -> Dict[str, float]:
+    """Counters for parsing error recovery and the share that needed the LLM fallback"""
+    with _recovery_lock:
+        total = PARSER_RECOVERY["local"] + PARSER_RECOVERY["llm_fallback"]
+        return {**PARSER_RECOVERY, "fallback_rate": PARSER_RECOVERY["llm_fallback"] / total if total else 0.0}
+
+
+def _reformat_chain(llm) -> LLMChain:
+    return LLMChain(
+            llm=llm, 
+                prompt=PromptTemplate(input_variables=["error"],template='Remove any json formating from the below text, also remove any portion that says someting similar this "Could not parse LLM output: ". Reformat your response in beautiful Markdown. Just give me the reformated text, nothing else.\n Text: {error}'), 
+            verbose=False
+        )
+
+
+def run_agent(question:str, agent_chain: AgentExecutor, callbacks: Optional[List[BaseCallbackHandler]] = None,
+              session_id: Optional[str] = None) -> str:
+    """Function to run the brain agent and deal with potential parsing errors.
+
+    With a session_id the agent sees the conversation so far and the answer is added to it.
+    Identical questions asked of the same agent at the same time share one run, unless callbacks are given.
+    """
+    if COALESCE_REQUESTS and not callbacks:
+        key = question_key("agent", question, id(agent_chain), session_id)
+        return SINGLE_FLIGHT.do(key, lambda: _run_agent(question, agent_chain, session_id=session_id))
+    return _run_agent(question, agent_chain, callbacks, session_id)
+
+
+def agent_input(question: str, session_id: Optional[str] = None) -> str:
+    """The agent's input: the question, followed by the conversation so far when asked within a session"""
+    history = get_memory().history(session_id) if session_id else ""
+    if not history:
+        return question
+    return f"{question}\n\nConversation so far (the question may refer to it):\n{history}"
+
+
+def _run_agent(question:str, agent_chain: AgentExecutor, callbacks: Optional[List[BaseCallbackHandler]] = None,
+               session_id: Optional[str] = None) -> str:
     try:
-        response = agent_chain.run(input=question)
-        return response
+        response = agent_chain.run(input=agent_input(question, session_id), callbacks=(callbacks or []) + metrics.callbacks())
     
     except OutputParserException as e:
-        # If the agent has a parsing error, we use OpenAI model again to reformat the error and give a good answer
-        chatgpt_chain = LLMChain(
-                llm=agent_chain.agent.llm_chain.llm, 
-                    prompt=PromptTemplate(input_variables=["error"],template='Remove any json formating from the below text, also remove any portion that says someting similar this "Could not parse LLM output: ". Reformat your response in beautiful Markdown. Just give me the reformated text, nothing else.\n Text: {error}'), 
-                verbose=False
-            )
-
-        response = chatgpt_chain.run(str(e.llm_output))
-        return response
+        with metrics.span("parser_recovery"):
+            response = recover_answer(e, agent_chain.agent.llm_chain.llm)
+    if session_id:
+        get_memory().add_turn(session_id, question, response)
+    return response
+
+
+def recover_answer(error: OutputParserException, llm) -> str:
+    """Answer text from a parsing error: extracted locally when possible, otherwise reformatted by the LLM"""
+    answer = extract_answer(error.llm_output)
+    if answer:
+        _count_recovery("local")
+        return answer
+
+    # If the answer can't be extracted, we use OpenAI model again to reformat the error and give a good answer
+    _count_recovery("llm_fallback")
+    chatgpt_chain = _reformat_chain(llm)
+    return chatgpt_chain.run(str(error.llm_output or error))
+
+
+async def arecover_answer(error: OutputParserException, llm) -> str:
+    """Async version of recover_answer"""
+    answer = extract_answer(error.llm_output)
+    if answer:
+        _count_recovery("local")
+        return answer
+
+    _count_recovery("llm_fallback")
+    chatgpt_chain = _reformat_chain(llm)
+    return await chatgpt_chain.arun(str(error.llm_output or error))
+
+
+async def arun_agent(question:str, agent_chain: AgentExecutor, callbacks: Optional[List[BaseCallbackHandler]] = None,
+                     session_id: Optional[str] = None) -> str:
+    """Async version of run_agent, limited to LLM_MAX_CONCURRENCY concurrent runs"""
+    if COALESCE_REQUESTS and not callbacks:
+        key = question_key("agent", question, id(agent_chain), session_id)
+        return await SINGLE_FLIGHT.ado(key, lambda: _arun_agent(question, agent_chain, session_id=session_id))
+    return await _arun_agent(question, agent_chain, callbacks, session_id)
+
+
+async def _arun_agent(question:str, agent_chain: AgentExecutor, callbacks: Optional[List[BaseCallbackHandler]] = None,
+                      session_id: Optional[str] = None) -> str:
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+    async with _llm_semaphore:
+        try:
+            response = await agent_chain.arun(input=agent_input(question, session_id), callbacks=(callbacks or []) + metrics.callbacks())
+
+        except OutputParserException as e:
+            with metrics.span("parser_recovery"):
+                response = await arecover_answer(e, agent_chain.agent.llm_chain.llm)
+    if session_id:
+        await get_memory().aadd_turn(session_id, question, response)
+    return response
+
+
+_DONE = object()
+
+
+def stream_run(run: Callable[[List[BaseCallbackHandler]], Any], answer_prefix: Optional[str] = None) -> Iterator[Any]:
+    """Run `run(callbacks)` in a worker thread and yield its streamed tokens as they arrive.
+
+    The last item yielded is whatever `run` returns (e.g. a dict with the final answer and sources).
+    Exceptions raised by `run` are re-raised in the caller. The LLM must have streaming enabled.
+    """
+    tokens = queue.Queue()
+    outcome = {}
+
+    def worker():
+        try:
+            outcome["result"] = run([QueueCallbackHandler(tokens, answer_prefix=answer_prefix)])
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            tokens.put(_DONE)
+
+    # Run in a copy of the caller's context so the request trace follows the work into the thread
+    threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True).start()
+    while True:
+        token = tokens.get()
+        if token is _DONE:
+            break
+        yield token
+    if "error" in outcome:
+        raise outcome["error"]
+    yield outcome["result"]
+
+
+async def astream_run(run: Callable[[List[BaseCallbackHandler]], Awaitable[Any]], answer_prefix: Optional[str] = None) -> AsyncIterator[Any]:
+    """Async version of stream_run: `run(callbacks)` is a coroutine function scheduled on the running loop"""
+    tokens = asyncio.Queue()
+    task = asyncio.ensure_future(run([AsyncQueueCallbackHandler(tokens, answer_prefix=answer_prefix)]))
+    task.add_done_callback(lambda _: tokens.put_nowait(_DONE))
+    try:
+        while True:
+            token = await tokens.get()
+            if token is _DONE:
+                break
+            yield token
+        yield task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def _answer_if_silent(stream: Iterator[Any]) -> Iterator[Any]:
+    """Pass the stream through, sending the answer as one chunk if no token was streamed.
+
+    An answer recovered from a parsing error never followed "Final Answer:", so it was not streamed.
+    """
+    streamed = False
+    for item in stream:
+        if isinstance(item, dict):
+            if not streamed:
+                yield item["answer"]
+        else:
+            streamed = True
+        yield item
+
+
+async def _aanswer_if_silent(stream: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """Async version of _answer_if_silent"""
+    streamed = False
+    async for item in stream:
+        if isinstance(item, dict):
+            if not streamed:
+                yield item["answer"]
+        else:
+            streamed = True
+        yield item
+
+
+def stream_agent(question: str, agent_chain: AgentExecutor, session_id: Optional[str] = None) -> Iterator[Union[str, Dict]]:
+    """Stream the agent's final answer token by token, then yield {'answer': full answer}.
+
+    The agent's LLM must have streaming enabled. Callers streaming the same question at the same
+    time all read from one run.
+    """
+    def run():
+        return _answer_if_silent(stream_run(
+            lambda callbacks: {"answer": run_agent(question, agent_chain, callbacks=callbacks, session_id=session_id)},
+            answer_prefix="Final Answer:"))
+
+    if COALESCE_REQUESTS:
+        return SINGLE_FLIGHT.stream(question_key("stream_agent", question, id(agent_chain), session_id), run)
+    return run()
+
+
+def astream_agent(question: str, agent_chain: AgentExecutor, session_id: Optional[str] = None) -> AsyncIterator[Union[str, Dict]]:
+    """Async version of stream_agent"""
+    async def run_agent_with(callbacks):
+        return {"answer": await arun_agent(question, agent_chain, callbacks=callbacks, session_id=session_id)}
+
+    def run():
+        return _aanswer_if_silent(astream_run(run_agent_with, answer_prefix="Final Answer:"))
+
+    if COALESCE_REQUESTS:
+        return SINGLE_FLIGHT.astream(question_key("stream_agent", question, id(agent_chain), session_id), run)
+    return run()
+
+
+def bing_results(query: str, k: int = 5) -> List[Dict]:
+    """Search results for a query from the configured backend (cached Bing by default), compacted for prompts.
+
+    With FETCH_PAGES on, the top results also carry the relevant passages of their pages.
+    """
+    with metrics.span("search"):
+        results = get_search_backend().results(query, k)
+    if FETCH_PAGES:
+        with metrics.span("fetch"):
+            results = enrich_results(query, results)
+    return compact_results(results)
+
+
+async def abing_results(query: str, k: int = 5) -> List[Dict]:
+    """Async version of bing_results"""
+    with metrics.span("search"):
+        results = await get_search_backend().aresults(query, k)
+    if FETCH_PAGES:
+        with metrics.span("fetch"):
+            results = await asyncio.to_thread(enrich_results, query, results)
+    return compact_results(results)
     
 
 ######## TOOL CLASSES #####################################
@@ -45,17 +344,25 @@ class BingSearchResults(BaseTool):
     description = "useful when the questions includes the term: @bing.\n"
 
     k: int = 5
+    # Raise search failures (e.g. throttling) instead of telling the agent nothing was found
+    raise_errors: bool = False
 
     def _run(self, query: str) -> str:
-        bing = BingSearchAPIWrapper(k=self.k)
         try:
-            return bing.results(query,num_results=self.k)
+            return bing_results(query, k=self.k)
         except:
+            if self.raise_errors:
+                raise
             return "No Results Found"
     
     async def _arun(self, query: str) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("BingSearchResults does not support async")
+        try:
+            return await abing_results(query, k=self.k)
+        except:
+            if self.raise_errors:
+                raise
+            return "No Results Found"
             
 
 class BingSearchTool(BaseTool):
@@ -64,35 +371,73 @@ class BingSearchTool(BaseTool):
     name = "@bing"
     description = "useful when the questions includes the term: @bing.\n"
     
-    llm: AzureChatOpenAI
+    llm: BaseChatModel
     k: int = 5
+    prefix: str = BING_PROMPT_PREFIX
+    # Let search and LLM failures reach the caller (e.g. the batch runner, to retry them) instead of printing them
+    raise_errors: bool = False
     
-    def _run(self, tool_input: Union[str, Dict],) -> str:
-        try:
-            tools = [BingSearchResults(k=self.k)]
-            parsed_input = self._parse_input(tool_input)
+    def _build_executor(self) -> AgentExecutor:
+        tools = [BingSearchResults(k=self.k, raise_errors=self.raise_errors), DocSearchTool(k=self.k)]
+        return initialize_agent(tools=tools, 
+                                llm=self.llm, 
+                                agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
+                                agent_kwargs={'prefix':self.prefix},
+                                callback_manager=self.callbacks,
+                                verbose=self.verbose,
+                                handle_parsing_errors=True)
 
-            agent_executor = initialize_agent(tools=tools, 
-                                              llm=self.llm, 
-                                              agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
-                                              agent_kwargs={'prefix':BING_PROMPT_PREFIX},
-                                              callback_manager=self.callbacks,
-                                              verbose=self.verbose,
-                                              handle_parsing_errors=True)
-            
+    def _config(self) -> tuple:
+        return (id(self.llm), self.k, self.prefix, id(self.callbacks), self.verbose, self.raise_errors)
+
+    def _executor(self):
+        """Check out a pooled executor for this tool's configuration, building it only the first time"""
+        return EXECUTOR_POOL.acquire(self._config(), self._build_executor, pin=(self.llm, self.callbacks))
+
+    def _answer(self, question: str) -> str:
+        with self._executor() as agent_executor:
             for i in range(1):
                 try:
-                    response = run_agent(parsed_input, agent_executor)
+                    response = run_agent(question, agent_executor)
                     break
                 except Exception as e:
+                    if self.raise_errors:
+                        raise
                     response = str(e)
                     continue
+        return response
 
-            return response
+    async def _aanswer(self, question: str) -> str:
+        with self._executor() as agent_executor:
+            return await arun_agent(question, agent_executor)
+
+    def _run(self, tool_input: Union[str, Dict],) -> str:
+        try:
+            parsed_input = self._parse_input(tool_input)
+            
+            with metrics.trace("BingSearchTool"):
+                # A burst of the same question shares one agent run
+                if COALESCE_REQUESTS:
+                    key = question_key("BingSearchTool", parsed_input, *self._config())
+                    return SINGLE_FLIGHT.do(key, lambda: self._answer(parsed_input))
+                return self._answer(parsed_input)
         
         except Exception as e:
+            if self.raise_errors:
+                raise
             print(e)
     
-    async def _arun(self, query: str) -> str:
+    async def _arun(self, tool_input: Union[str, Dict],) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("BingSearchTool does not support async")
\ No newline at end of file
+        try:
+            parsed_input = self._parse_input(tool_input)
+            with metrics.trace("BingSearchTool"):
+                if COALESCE_REQUESTS:
+                    key = question_key("BingSearchTool", parsed_input, *self._config())
+                    return await SINGLE_FLIGHT.ado(key, lambda: self._aanswer(parsed_input))
+                return await self._aanswer(parsed_input)
+
+        except Exception as e:
+            if self.raise_errors:
+                raise
+            print(e)
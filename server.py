@@ -0,0 +1,207 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+# Process start, for the cold start time; heavy modules (langchain, the pipelines) are imported in build_assistant
+STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from common.config import configure_environment
+
+###
+# Long-running service answering questions over HTTP, for uvicorn or any ASGI server:
+#   uvicorn server:app --host 0.0.0.0 --port 8000 --workers 4
+# The LLM client, tools and agent are built once per worker process at startup, not per request.
+#   POST /ask          {"question": "...", "session_id": optional} -> {"answer", "sources", "path", "latency"}
+#   POST /ask/stream   same body, answer tokens as server-sent events, then a "done" event with the payload
+#                      (an "error" event instead if it fails or the server stays too busy)
+#   GET  /health       cold start time (imports, build), requests in flight, per-path routing stats and LLM deployment health
+#   GET  /metrics      Prometheus metrics (with METRICS_ENABLED=true)
+###
+
+# Requests answered at once by a worker; others wait up to SERVER_QUEUE_TIMEOUT seconds, then get a 503
+SERVER_MAX_CONCURRENCY = int(os.environ.get("SERVER_MAX_CONCURRENCY", 16))
+SERVER_QUEUE_TIMEOUT = float(os.environ.get("SERVER_QUEUE_TIMEOUT", 5))
+
+
+class Question(BaseModel):
+    question: str
+    # Questions sent with the same session_id are answered as one conversation
+    session_id: Optional[str] = None
+
+
+class Assistant:
+    """Everything a worker needs to answer questions, built once"""
+
+    def __init__(self, llm, agent, router, timings: Dict[str, float]):
+        self.llm = llm
+        self.agent = agent
+        self.router = router
+        self.timings = timings
+
+
+def build_assistant() -> Assistant:
+    """Import the pipelines and build the LLM client, agent and router, timing each step"""
+    timings = {}
+    start = time.perf_counter()
+    configure_environment()
+    from common.router import COMPOUND_PIPELINE, QuestionRouter
+    from common.utils import arun_agent
+    from using_agents import build_agent, build_llm
+    from using_bing_search import aanswer_question
+    timings["imports"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    llm = build_llm()
+    agent = build_agent(llm, verbose=False)
+
+    async def simple(question: str, session_id: Optional[str] = None) -> Dict:
+        result = await aanswer_question(question, llm=llm, session_id=session_id)
+        return {"answer": result["answer"], "sources": result["sources"]}
+
+    async def agent_answer(question: str, session_id: Optional[str] = None) -> Dict:
+        return {"answer": await arun_agent(question, agent, session_id=session_id), "sources": []}
+
+    router = QuestionRouter(simple=simple, compound=agent_answer if COMPOUND_PIPELINE == "agent" else simple)
+    timings["build"] = time.perf_counter() - start
+    return Assistant(llm, agent, router, timings)
+
+
+class ConcurrencyLimit:
+    """Admits up to `limit` requests at once; the rest queue for at most `timeout` seconds"""
+
+    def __init__(self, limit: int, timeout: float):
+        self.limit = limit
+        self.timeout = timeout
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> None:
+        try:
+            if self.timeout > 0:
+                await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            elif self._semaphore.locked():
+                raise asyncio.TimeoutError
+            else:
+                await self._semaphore.acquire()
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Too many requests in progress, try again shortly",
+                                headers={"Retry-After": "1"})
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.assistant = None
+    app.state.limit = ConcurrencyLimit(SERVER_MAX_CONCURRENCY, SERVER_QUEUE_TIMEOUT)
+    # Building imports langchain and may block for a few seconds, keep the event loop free meanwhile
+    assistant = await asyncio.to_thread(build_assistant)
+    assistant.timings["cold_start"] = time.perf_counter() - STARTED
+    app.state.assistant = assistant
+    print("ready in {cold_start:.2f}s (imports {imports:.2f}s, build {build:.2f}s)".format(**assistant.timings), flush=True)
+    yield
+    from common import bing
+    await bing.close_session()
+
+
+app = FastAPI(title="Leicestershire County Council assistant", lifespan=lifespan)
+
+
+def _assistant() -> Assistant:
+    if app.state.assistant is None:
+        raise HTTPException(status_code=503, detail="Starting up")
+    return app.state.assistant
+
+
+@app.post("/ask")
+async def ask(body: Question) -> Dict:
+    assistant = _assistant()
+    from common import metrics
+    await app.state.limit.acquire()
+    try:
+        with metrics.trace("server"):
+            routed = await assistant.router.aroute(body.question, session_id=body.session_id)
+    finally:
+        app.state.limit.release()
+    return {**routed["result"], "path": routed["path"], "latency": routed["latency"]}
+
+
+def _event(data, event: Optional[str] = None) -> str:
+    return (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+
+
+@app.post("/ask/stream")
+async def ask_stream(body: Question) -> StreamingResponse:
+    assistant = _assistant()
+    from common import metrics
+    from common.router import COMPOUND, COMPOUND_PIPELINE, routed
+    from common.utils import astream_agent
+    from using_bing_search import astream_answer
+
+    # The slot is taken and given back inside the generator: one that never starts (the client left
+    # before the response began) holds nothing. A full server is reported as an "error" event.
+    async def events() -> AsyncIterator[str]:
+        started = time.perf_counter()
+        try:
+            await app.state.limit.acquire()
+        except HTTPException as e:
+            yield _event({"error": e.detail, "status": e.status_code}, event="error")
+            return
+        try:
+            with metrics.trace("server"):
+                path = assistant.router.classify(body.question)
+                if path == COMPOUND and COMPOUND_PIPELINE == "agent":
+                    stream = astream_agent(body.question, assistant.agent, session_id=body.session_id)
+                else:
+                    stream = astream_answer(body.question, llm=assistant.llm, session_id=body.session_id)
+                with routed(path):
+                    async for item in stream:
+                        if isinstance(item, dict):
+                            yield _event({**item, "path": path, "latency": time.perf_counter() - started}, event="done")
+                        else:
+                            yield _event(item)
+                assistant.router.record(body.question, path, started)
+        except Exception as e:
+            yield _event({"error": str(e)}, event="error")
+        finally:
+            app.state.limit.release()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/health")
+async def health() -> Dict:
+    assistant = _assistant()
+    limit = app.state.limit
+    from common.llm_pool import pool_stats
+    return {
+        "status": "ok",
+        "cold_start_seconds": round(assistant.timings["cold_start"], 3),
+        "startup": {name: round(seconds, 3) for name, seconds in assistant.timings.items()},
+        "in_flight": limit.in_flight,
+        "max_concurrency": limit.limit,
+        "routes": assistant.router.stats(),
+        "deployments": pool_stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics() -> str:
+    from common import metrics
+    return metrics.render_prometheus()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host=os.environ.get("HOST", "127.0.0.1"), port=int(os.environ.get("PORT", 8000)))
@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import time
+
+from common.singleflight import SingleFlight, question_key
+
+N = 50
+
+
+class Upstream:
+    """Counts the calls that reach it, standing in for Bing or the LLM"""
+
+    def __init__(self, delay: float = 0.2):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _count(self) -> int:
+        with self._lock:
+            self.calls += 1
+            return self.calls
+
+    def call(self) -> str:
+        call = self._count()
+        time.sleep(self.delay)
+        return f"answer {call}"
+
+    async def acall(self) -> str:
+        call = self._count()
+        await asyncio.sleep(self.delay)
+        return f"answer {call}"
+
+    def stream(self):
+        self._count()
+        for token in ["The ", "fee ", "is ", "£150"]:
+            time.sleep(self.delay / 4)
+            yield token
+        yield {"answer": "The fee is £150"}
+
+    async def astream(self):
+        self._count()
+        for token in ["The ", "fee ", "is ", "£150"]:
+            await asyncio.sleep(self.delay / 4)
+            yield token
+        yield {"answer": "The fee is £150"}
+
+
+def run_threads(target, n: int = N) -> list:
+    """Start n threads at once, each calling target(), and return their results"""
+    barrier = threading.Barrier(n)
+    results = [None] * n
+
+    def worker(i):
+        barrier.wait()
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_question_key_ignores_case_and_spacing():
+    assert question_key("search", "Dropped kerb cost?") == question_key("search", "  dropped   KERB cost")
+    assert question_key("search", "Dropped kerb cost?") != question_key("agent", "Dropped kerb cost?")
+
+
+def test_do_makes_one_call_for_concurrent_identical_requests():
+    flight, upstream = SingleFlight(), Upstream()
+    results = run_threads(lambda: flight.do("kerb", upstream.call))
+    assert upstream.calls == 1
+    assert results == ["answer 1"] * N
+    assert flight.stats() == {"calls": 1, "shared": N - 1, "in_flight": 0}
+
+
+def test_do_shares_the_error():
+    flight, upstream = SingleFlight(), Upstream()
+
+    def fail():
+        upstream.call()
+        raise RuntimeError("throttled")
+
+    results = run_threads(lambda: flight.do("kerb", fail))
+    assert upstream.calls == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_do_calls_again_once_the_call_is_done():
+    flight, upstream = SingleFlight(), Upstream(delay=0)
+    assert flight.do("kerb", upstream.call) == "answer 1"
+    assert flight.do("kerb", upstream.call) == "answer 2"
+    assert upstream.calls == 2
+
+
+def test_ado_makes_one_call_for_concurrent_identical_requests():
+    flight, upstream = SingleFlight(), Upstream()
+
+    async def main():
+        return await asyncio.gather(*(flight.ado("kerb", upstream.acall) for _ in range(N)))
+
+    assert asyncio.run(main()) == ["answer 1"] * N
+    assert upstream.calls == 1
+
+
+def test_ado_keeps_the_call_running_when_a_caller_is_cancelled():
+    flight, upstream = SingleFlight(), Upstream()
+
+    async def main():
+        leader = asyncio.ensure_future(flight.ado("kerb", upstream.acall))
+        follower = asyncio.ensure_future(flight.ado("kerb", upstream.acall))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == "answer 1"
+    assert upstream.calls == 1
+
+
+def test_stream_makes_one_call_and_every_caller_gets_every_item():
+    flight, upstream = SingleFlight(), Upstream()
+    results = run_threads(lambda: list(flight.stream("kerb", upstream.stream)), n=20)
+    assert upstream.calls == 1
+    assert all(r == ["The ", "fee ", "is ", "£150", {"answer": "The fee is £150"}] for r in results)
+
+
+def test_astream_makes_one_call_and_every_caller_gets_every_item():
+    flight, upstream = SingleFlight(), Upstream()
+
+    async def consume():
+        return [item async for item in flight.astream("kerb", upstream.astream)]
+
+    async def main():
+        return await asyncio.gather(*(consume() for _ in range(N)))
+
+    results = asyncio.run(main())
+    assert upstream.calls == 1
+    assert all(r == ["The ", "fee ", "is ", "£150", {"answer": "The fee is £150"}] for r in results)
+
+
+def test_astream_shares_the_error():
+    flight = SingleFlight()
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        yield "The "
+        raise RuntimeError("throttled")
+
+    async def consume():
+        return [item async for item in flight.astream("kerb", failing)]
+
+    async def main():
+        return await asyncio.gather(*(consume() for _ in range(10)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_different_keys_are_not_coalesced():
+    flight, upstream = SingleFlight(), Upstream()
+    counter = iter(range(N))
+    results = run_threads(lambda: flight.do("kerb" if next(counter) % 2 else "tip", upstream.call))
+    assert upstream.calls == 2
+    assert set(results) == {"answer 1", "answer 2"}
@@ -1,22 +1,19 @@
-from time import sleep
-from langchain.chat_models import AzureChatOpenAI
-from langchain.agents import initialize_agent, AgentType, Tool
-from langchain.utilities import BingSearchAPIWrapper
-from dotenv import load_dotenv
-import os
+from langchain.chat_models.base import BaseChatModel
+from langchain.agents import AgentExecutor, initialize_agent, AgentType, Tool
 from langchain.schema import OutputParserException
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
 from langchain.tools import BaseTool
+from common.config import configure_environment
+from common.docsearch import DocSearchTool
+from common.llm_pool import build_chat_model
+from common.utils import bing_results, abing_results, stream_agent, recover_answer
+from common.router import COMPOUND_PIPELINE, QuestionRouter
+from common import metrics
+from using_bing_search import stream_answer
 
-load_dotenv("credentials.env")
+configure_environment()
 MODEL_DEPLOYMENT_NAME = "gpt-35-turbo-16k"
 # MODEL_DEPLOYMENT_NAME = "gpt-4"
 # MODEL_DEPLOYMENT_NAME = "text-davinci-003" # Reminder: gpt-35-turbo models will create parsing errors and won't follow instructions correctly 
-os.environ["OPENAI_API_BASE"] = os.environ["AZURE_OPENAI_ENDPOINT"]
-os.environ["OPENAI_API_KEY"] = os.environ["AZURE_OPENAI_API_KEY"]
-os.environ["OPENAI_API_VERSION"] = os.environ["AZURE_OPENAI_API_VERSION"]
-os.environ["OPENAI_API_TYPE"] = "azure"
 
 PREFIX = """
 - You are a bot that helps answer questions related to Leicestershire County Council
@@ -47,10 +44,10 @@ PREFIX = """
 
 ## This is and example of how you must provide the answer:
 
-Question: Who is the current president of the United States?
+Question: Application cost to drop the kerb?
 
 Context: 
-[{{'snippet': 'There is an initial non-refundable <b>application</b> <b>fee</b> of £150 for an Officer to process the <b>application</b> to assess whether an access will be allowed. This <b>fee</b> must be sent with the...', 'title': 'Vehicle access (dropped kerbs) | Leicestershire County Council', 'link': 'https://www.leicestershire.gov.uk/roads-and-travel/cars-and-parking/vehicle-access-dropped-kerbs'}}, {{'snippet': 'Thank you for your enquiry regarding the construction of a new vehicle access (<b>dropped</b> <b>kerbs</b>). This process is in place to help people gain access from the road, across footways and verges,...', 'title': 'Vehicle access - information pack - Leicestershire County Council', 'link': 'https://www.leicestershire.gov.uk/sites/default/files/2023-02/VA1-Information-Pack.pdf'}}, {{'snippet': 'A to Z Home Roads and travel Road maintenance Highways<b> permits</b> and<b> licences Apply</b> for licences to place items, or carry out work on roads in<b> Leicestershire</b> Update We&#39;ll continue to accept...', 'title': 'Highways permits and licences | Leicestershire County Council', 'link': 'https://www.leicestershire.gov.uk/roads-and-travel/road-maintenance/highways-permits-and-licences'}}, {{'snippet': 'A standard access is 4 <b>dropped</b> <b>kerbs</b>. Requests for a wider access may not be granted. Stage 1 In some places, space or safety considerations or steep slopes will make it impossible to construct...', 'title': 'Roads &amp; Highways - Vehicle Access Requests - Leicestershire County Council', 'link': 'https://www.leicestershire.gov.uk/sites/default/files/field/pdf/2015/12/15/vehicle_access_info_pack.pdf'}}]
+[{{'snippet': 'There is an initial non-refundable application fee of £150 for an Officer to process the application to assess whether an access will be allowed.', 'title': 'Vehicle access (dropped kerbs) | Leicestershire County Council', 'link': 'https://www.leicestershire.gov.uk/roads-and-travel/cars-and-parking/vehicle-access-dropped-kerbs'}}, {{'snippet': 'A standard access is 4 dropped kerbs. Requests for a wider access may not be granted.', 'title': 'Roads & Highways - Vehicle Access Requests - Leicestershire County Council', 'link': 'https://www.leicestershire.gov.uk/sites/default/files/field/pdf/2015/12/15/vehicle_access_info_pack.pdf'}}]
 
 Final Answer: The cost to drop a kerb in Leicestershire is **£150** for the initial application fee. <sup><a href="https://www.leicestershire.gov.uk/roads-and-travel/cars-and-parking/vehicle-access-dropped-kerbs">[1]</a></sup>. \n Anything else I can help you with?
 
@@ -64,40 +61,66 @@ class BingSearchTool(BaseTool):
     k: int = 5
 
     def _run(self, query: str) -> str:
-        bing = BingSearchAPIWrapper(k=self.k)
         try:
-            return bing.results(query,num_results=self.k)
+            return bing_results(query, k=self.k)
         except:
             return "No Results Found"
     
     async def _arun(self, query: str) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("BingSearchResults does not support async")
-
-
-llm = AzureChatOpenAI(deployment_name=MODEL_DEPLOYMENT_NAME, temperature=0.3, max_tokens=1000)
-www_search = BingSearchAPIWrapper(k=5)
-search_tool = BingSearchTool()
-## The below line of code returns the answer to the question from Bing Search and not the results from Bing Search
-# www_search_tool = Tool(name="web search", description="bing search", func=www_search.run)
-## The below line of code returns the results from Bing Search and not the answer to the question from Bing Search
-www_search_tool = Tool(name="web search", description="bing search", func=search_tool.run)
-tools = [www_search_tool]
-agent_chain = initialize_agent(llm=llm, tools=tools, agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, verbose=True, agent_kwargs={"prefix": PREFIX})
-try:
-    # print(agent_chain("Application cost to drop the kerb?")['output'])
-    print(agent_chain("How do I make a Big Mac at home?")['output'])
-    # wait for 10 seconds
-    sleep(10)
-    print(agent_chain("What options are available for Adult Social care? How much would they cost?")['output'])
-except OutputParserException as e:
-    chatgpt_chain = LLMChain(
-                llm=agent_chain.agent.llm_chain.llm, 
-                    prompt=PromptTemplate(input_variables=["error"],template='Remove any json formating from the below text, also remove any portion that says someting similar this "Could not parse LLM output: ". Reformat your response in beautiful Markdown. Just give me the reformated text, nothing else.\n Text: {error}'), 
-                verbose=False
-            )
-
-    response = chatgpt_chain.run(str(e.llm_output))
-    if response is None:
-        response = chatgpt_chain.run(str(e))
-    print(response)
\ No newline at end of file
+        try:
+            return await abing_results(query, k=self.k)
+        except:
+            return "No Results Found"
+
+
+def build_llm() -> BaseChatModel:
+    """MODEL_DEPLOYMENT_NAME, or a pool of deployments with failover when LLM_DEPLOYMENTS is set"""
+    return build_chat_model(MODEL_DEPLOYMENT_NAME, temperature=0.3, max_tokens=1000, streaming=True)
+
+
+def build_agent(llm: BaseChatModel, verbose: bool = True) -> AgentExecutor:
+    """The agent answering compound questions, searching the council website through Bing or the @docsearch index"""
+    search_tool = BingSearchTool()
+    ## The below line of code returns the answer to the question from Bing Search and not the results from Bing Search
+    # www_search_tool = Tool(name="web search", description="bing search", func=BingSearchAPIWrapper(k=5).run)
+    ## The below line of code returns the results from Bing Search and not the answer to the question from Bing Search
+    www_search_tool = Tool(name="web search", description="bing search", func=search_tool.run, coroutine=search_tool.arun)
+    # @docsearch, advertised in the welcome message: the local hybrid index of the council website
+    doc_search_tool = DocSearchTool()
+    tools = [www_search_tool, Tool(name=doc_search_tool.name, description=doc_search_tool.description,
+                                   func=doc_search_tool.run, coroutine=doc_search_tool.arun)]
+    return initialize_agent(llm=llm, tools=tools, agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, verbose=verbose, agent_kwargs={"prefix": PREFIX})
+
+
+def print_stream(stream) -> None:
+    """Print an answer as it is streamed"""
+    for item in stream:
+        if isinstance(item, str):
+            print(item, end="", flush=True)
+    print()
+
+
+def print_answer(question: str, router: QuestionRouter) -> None:
+    with metrics.trace("using_agents"):
+        routed = router.route(question)
+    print(f"({routed['path']} path, {routed['latency']:.1f}s)")
+
+
+if __name__ == "__main__":
+    llm = build_llm()
+    agent_chain = build_agent(llm)
+    # Single-intent questions only need one search and one LLM call; compound ones are split into
+    # concurrent searches answered the same way, or go to the agent with COMPOUND_PIPELINE=agent
+    answer = lambda question: print_stream(stream_answer(question))
+    compound = answer
+    if COMPOUND_PIPELINE == "agent":
+        compound = lambda question: print_stream(stream_agent(question, agent_chain))
+    router = QuestionRouter(simple=answer, compound=compound)
+
+    try:
+        # print_answer("Application cost to drop the kerb?", router)
+        print_answer("How do I make a Big Mac at home?", router)
+        print_answer("What options are available for Adult Social care? How much would they cost?", router)
+    except OutputParserException as e:
+        print(recover_answer(e, agent_chain.agent.llm_chain.llm))
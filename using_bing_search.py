@@ -1,27 +1,43 @@
+import asyncio
 import os
-import requests
-from langchain.chat_models import AzureChatOpenAI
-from dotenv import load_dotenv
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings import OpenAIEmbeddings
 from pprint import pprint
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 from langchain.tools import BaseTool
-from langchain.utilities import BingSearchAPIWrapper
+from common.answer_cache import SemanticAnswerCache, results_fingerprint
+from common.cache import get_search_cache, make_key
+from common.context import build_context, count_tokens
+from common.decompose import asearch_all, decompose, search_all
+from common.fetch import FETCH_PAGES, enrich_results
+from common.llm_pool import build_chat_model
+from common.memory import get_memory
+from common import metrics
+from common.search import BingBackend, as_web_pages, get_search_backend
+from common import bing
+from common.config import configure_environment
+from common.singleflight import COALESCE_REQUESTS, SINGLE_FLIGHT, question_key
+from common.utils import bing_results, abing_results, stream_run, astream_run
+from typing import AsyncIterator, Iterator, Union
 
 
-load_dotenv("credentials.env")
+# Loads credentials.env once per process (the settings below may come from it); no clients are built at import
+configure_environment()
 
-os.environ["OPENAI_API_BASE"] = os.environ.get("AZURE_OPENAI_ENDPOINT")
-os.environ["OPENAI_API_KEY"] = os.environ.get("AZURE_OPENAI_API_KEY")
-os.environ["OPENAI_API_VERSION"] = os.environ.get("AZURE_OPENAI_API_VERSION")
-os.environ["OPENAI_API_TYPE"] = "azure"
-
-# Add your Bing Search V7 subscription key and endpoint to your environment variables.
-subscription_key = os.environ['BING_SUBSCRIPTION_KEY']
-endpoint = os.environ['BING_SEARCH_URL']
+# Add your Bing Search V7 subscription key and endpoint (BING_SUBSCRIPTION_KEY, BING_SEARCH_URL) to your environment variables.
 
 MODEL = "gpt-35-turbo-16k" # options: gpt-35-turbo, gpt-35-turbo-16k, gpt-4, gpt-4-32k
+# Set LLM_DEPLOYMENTS (see common/llm_pool.py) to spread the calls over several deployments instead
 COMPLETION_TOKENS = 1000
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_DEPLOYMENT_NAME", "text-embedding-ada-002")
+
+# Semantic answer cache: questions whose embeddings are at least this similar share an answer
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 1024))
+
+NO_ANSWER = "I'm sorry, I couldn't find an answer to your question on the Leicestershire County Council website."
 
 
 CUSTOM_CHATBOT_PREFIX = """
@@ -86,13 +102,10 @@ COMBINE_CHAT_PROMPT_TEMPLATE = CUSTOM_CHATBOT_PREFIX +  """
 Question: Who is the current president of the United States?
 
 Web results: 
-[{{'snippet': 'U.S. facts and figures Presidents,<b></b> vice presidents,<b></b> and first ladies Presidents,<b></b> vice presidents,<b></b> and first ladies Learn about the duties of <b>president</b>, vice <b>president</b>, and first lady <b>of the United</b> <b>States</b>. Find out how to contact and learn more about <b>current</b> and past leaders. <b>President</b> <b>of the United</b> <b>States</b> Vice <b>president</b> <b>of the United</b> <b>States</b>',
+[{{'snippet': 'Learn about the duties of president, vice president, and first lady of the United States.',
   'title': 'Presidents, vice presidents, and first ladies | USAGov',
   'link': 'https://www.usa.gov/presidents'}},
- {{'snippet': 'The 1st <b>President</b> <b>of the United</b> <b>States</b> John Adams The 2nd <b>President</b> <b>of the United</b> <b>States</b> Thomas Jefferson The 3rd <b>President</b> <b>of the United</b> <b>States</b> James Madison The 4th <b>President</b>...',
-  'title': 'Presidents | The White House',
-  'link': 'https://www.whitehouse.gov/about-the-white-house/presidents/'}},
- {{'snippet': 'Download Official Portrait <b>President</b> Biden represented Delaware for 36 years in the U.S. Senate before becoming the 47th Vice <b>President</b> <b>of the United</b> <b>States</b>. As <b>President</b>, Biden will...',
+ {{'snippet': 'President Biden represented Delaware for 36 years in the U.S. Senate before becoming the 47th Vice President of the United States.',
   'title': 'Joe Biden: The President | The White House',
   'link': 'https://www.whitehouse.gov/administration/president-biden/'}}]
 
@@ -109,11 +122,55 @@ PROMPT = PromptTemplate(
     template=COMBINE_CHAT_PROMPT_TEMPLATE
 )
 
-def get_bing_results(query: str):
+# Same prompt with the conversation so far, for questions asked within a session
+CONVERSATION_PROMPT = PromptTemplate(
+    input_variables=["history", "results", "question"],
+    template=COMBINE_CHAT_PROMPT_TEMPLATE.replace("Web results: {results}", "Conversation so far (the question may refer to it):\n{history}\n\nWeb results: {results}", 1)
+)
+
+def get_bing_results(query: str, raise_errors: bool = False) -> dict:
+    """Raw Bing v7 response (as JSON) for the query, restricted to the council website and cached.
+
+    A failed search returns {} (answered as not found) unless `raise_errors` is set.
+    """
+    backend = get_search_backend()
+    if not isinstance(backend, BingBackend):
+        return as_web_pages(backend.results(query, 5))
     params = {'q': 'site:www.leicestershire.gov.uk '+query, 'mkt': 'en-GB', 'count': 5, 'offset': 0, 'safesearch': 'Moderate', 'answerCount': 3}
-    headers = { 'Ocp-Apim-Subscription-Key': subscription_key }
-    response = requests.get(endpoint, headers=headers, params=params)
-    return response
+    cache = get_search_cache()
+    key = make_key(params['q'], mkt=params['mkt'], count=params['count'])
+    results = cache.get(key)
+    if results is None:
+        try:
+            results = bing.search(params)
+        except bing.BingSearchError as e:
+            if raise_errors:
+                raise
+            print(e)
+            return {}
+        cache.set(key, results)
+    return results
+
+
+async def aget_bing_results(query: str, raise_errors: bool = False) -> dict:
+    """Async version of get_bing_results, using the pooled aiohttp session"""
+    backend = get_search_backend()
+    if not isinstance(backend, BingBackend):
+        return as_web_pages(await backend.aresults(query, 5))
+    params = {'q': 'site:www.leicestershire.gov.uk '+query, 'mkt': 'en-GB', 'count': 5, 'offset': 0, 'safesearch': 'Moderate', 'answerCount': 3}
+    cache = get_search_cache()
+    key = make_key(params['q'], mkt=params['mkt'], count=params['count'])
+    results = cache.get(key)
+    if results is None:
+        try:
+            results = await bing.asearch(params)
+        except bing.BingSearchError as e:
+            if raise_errors:
+                raise
+            print(e)
+            return {}
+        cache.set(key, results)
+    return results
 
 
 class MyBingSearch(BaseTool):
@@ -125,31 +182,243 @@ class MyBingSearch(BaseTool):
     k: int = 5
     
     def _run(self, query: str) -> str:
-        bing = BingSearchAPIWrapper(k=self.k)
-        return bing.results(query,num_results=self.k)
+        return bing_results(query, k=self.k)
             
     async def _arun(self, query: str) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("This Tool does not support async")
+        return await abing_results(query, k=self.k)
     
 
 ###
 # The code below uses Bing search to find the results to query/question asked by the user.
 # The results from Bing are then fed into the LLM model to generate the answer.
 # We are not relying on OpenAIs ability to find the answer, instead we are doing the heavy lifting of searching for the answer on Bing
-# The drawback of this approach is that for complex questions or multiple questions in one sentence, the answer may not be as we are solely relying on Bing search and not breaking it down
+# Questions asking several things are broken down into one search per part (common/decompose.py), run at the same time,
+# and answered from the merged results in a single LLM call
 ###
 
+_answer_cache = None
+
+def get_answer_cache() -> SemanticAnswerCache:
+    global _answer_cache
+    if _answer_cache is None:
+        embeddings = OpenAIEmbeddings(deployment=EMBEDDING_MODEL, chunk_size=1)
+        _answer_cache = SemanticAnswerCache(embeddings, threshold=ANSWER_CACHE_THRESHOLD, maxsize=ANSWER_CACHE_SIZE)
+    return _answer_cache
+
+
+def _prepare_context(question: str, webpages: dict, values: list, history: str = ""):
+    """Compact the (enriched) results into the prompt context.
+
+    Prompt tokens before and after compaction are only counted with METRICS_ENABLED (None otherwise),
+    since it means formatting and tokenizing the prompt twice.
+    """
+    context = build_context(values)
+    if not metrics.METRICS_ENABLED:
+        return context, None
+    prompt, extra = (CONVERSATION_PROMPT, {"history": history}) if history else (PROMPT, {})
+    prompt_tokens = {
+        "before": count_tokens(prompt.format(results=webpages, question=question, **extra)),
+        "after": count_tokens(prompt.format(results=context, question=question, **extra)),
+    }
+    return context, prompt_tokens
+
+
+def _conversation(question: str, session_id: str = None):
+    """(history, follow_up, reusable results) of the session the question is asked in"""
+    if not session_id:
+        return "", False, None
+    memory = get_memory()
+    follow_up = memory.is_follow_up(session_id, question)
+    return memory.history(session_id), follow_up, memory.reusable_results(session_id, question) if follow_up else None
+
+
+def _search_queries(question: str, session_id: str = None, follow_up: bool = False) -> list:
+    """A follow-up is searched with the conversation's topic added, a compound question with one query per part"""
+    if follow_up:
+        return [get_memory().search_query(session_id, question)]
+    return decompose(question)
+
+
+def _remember(result: dict, question: str, session_id: str = None, values: list = None) -> dict:
+    if session_id:
+        get_memory().add_turn(session_id, question, result["answer"], values)
+    return result
+
+
+async def _aremember(result: dict, question: str, session_id: str = None, values: list = None) -> dict:
+    if session_id:
+        await get_memory().aadd_turn(session_id, question, result["answer"], values)
+    return result
+
+
+def _chain_inputs(context: str, question: str, history: str):
+    if history:
+        return CONVERSATION_PROMPT, {"history": history, "results": context, "question": question}
+    return PROMPT, {"results": context, "question": question}
+
+
+def answer_question(question: str, llm: BaseChatModel = None, callbacks: list = None, session_id: str = None,
+                    raise_errors: bool = False) -> dict:
+    """Search the council website and summarize the results, returning {'answer', 'sources', 'cached', 'prompt_tokens'}.
+
+    A compound question is searched with one query per part, concurrently. With a session_id the
+    answer takes the conversation so far into account, and a follow-up about the same topic is
+    answered from the previous turn's results instead of a new search.
+    Concurrent calls with the same question (and LLM) share one search and LLM call unless callbacks are given.
+    'prompt_tokens' ({'before', 'after'} compaction) is only counted with METRICS_ENABLED.
+    With raise_errors a failed search raises BingSearchError instead of being answered as not found.
+    """
+    with metrics.trace("using_bing_search"):
+        if COALESCE_REQUESTS and not callbacks:
+            key = question_key("using_bing_search", question, id(llm), session_id, raise_errors)
+            return SINGLE_FLIGHT.do(key, lambda: _answer_question(question, llm, session_id=session_id, raise_errors=raise_errors))
+        return _answer_question(question, llm, callbacks, session_id, raise_errors)
+
+
+def _answer_question(question: str, llm: BaseChatModel = None, callbacks: list = None, session_id: str = None,
+                     raise_errors: bool = False) -> dict:
+    callbacks = (callbacks or []) + metrics.callbacks()
+    history, follow_up, values = _conversation(question, session_id)
+    if values is not None:
+        webpages, sources = values, [value["link"] for value in values]
+    else:
+        queries = _search_queries(question, session_id, follow_up)
+        with metrics.span("search", queries=len(queries)):
+            webpages = search_all(queries, lambda query: get_bing_results(query, raise_errors)).get("webPages")
+        if not webpages:
+            return _remember({"answer": NO_ANSWER, "sources": [], "cached": False, "prompt_tokens": None}, question, session_id)
+
+        values = webpages.get("value", [])
+        sources = [value["url"] for value in values]
+        fingerprint = results_fingerprint(values)
+        # Answers to follow-ups depend on the conversation, they can't be shared through the cache
+        if ANSWER_CACHE_ENABLED and not follow_up:
+            with metrics.span("answer_cache"):
+                # Embedded once, for the lookup and for caching the answer on a miss
+                question_vector = get_answer_cache().embed(question)
+                cached = get_answer_cache().lookup(question, fingerprint, question_vector)
+            if cached:
+                result = {"answer": cached["answer"], "sources": cached["sources"], "cached": True, "prompt_tokens": None}
+                return _remember(result, question, session_id, values)
+
+        if FETCH_PAGES:
+            # Snippets alone are often too thin to answer from, add the relevant passages of the top pages
+            with metrics.span("fetch"):
+                values = enrich_results(question, values)
+    context, prompt_tokens = _prepare_context(question, webpages, values, history)
+
+    llm = llm or build_chat_model(MODEL, max_tokens=COMPLETION_TOKENS)
+    prompt, inputs = _chain_inputs(context, question, history)
+    chain_chat = LLMChain(llm=llm, prompt=prompt)
+    result = chain_chat(inputs, callbacks=callbacks)
+    output_text = result["text"]
+    if ANSWER_CACHE_ENABLED and not follow_up:
+        get_answer_cache().add(question, fingerprint, output_text, sources, question_vector)
+    result = {"answer": output_text, "sources": sources, "cached": False, "prompt_tokens": prompt_tokens}
+    return _remember(result, question, session_id, values)
+
+
+async def aanswer_question(question: str, llm: BaseChatModel = None, callbacks: list = None, session_id: str = None,
+                           raise_errors: bool = False) -> dict:
+    """Async version of answer_question"""
+    with metrics.trace("using_bing_search"):
+        if COALESCE_REQUESTS and not callbacks:
+            key = question_key("using_bing_search", question, id(llm), session_id, raise_errors)
+            return await SINGLE_FLIGHT.ado(key, lambda: _aanswer_question(question, llm, session_id=session_id, raise_errors=raise_errors))
+        return await _aanswer_question(question, llm, callbacks, session_id, raise_errors)
+
+
+async def _aanswer_question(question: str, llm: BaseChatModel = None, callbacks: list = None, session_id: str = None,
+                            raise_errors: bool = False) -> dict:
+    callbacks = (callbacks or []) + metrics.callbacks()
+    history, follow_up, values = _conversation(question, session_id)
+    if values is not None:
+        webpages, sources = values, [value["link"] for value in values]
+    else:
+        queries = _search_queries(question, session_id, follow_up)
+        with metrics.span("search", queries=len(queries)):
+            webpages = (await asearch_all(queries, lambda query: aget_bing_results(query, raise_errors))).get("webPages")
+        if not webpages:
+            return await _aremember({"answer": NO_ANSWER, "sources": [], "cached": False, "prompt_tokens": None}, question, session_id)
+
+        values = webpages.get("value", [])
+        sources = [value["url"] for value in values]
+        fingerprint = results_fingerprint(values)
+        if ANSWER_CACHE_ENABLED and not follow_up:
+            with metrics.span("answer_cache"):
+                question_vector = await get_answer_cache().aembed(question)
+                cached = await get_answer_cache().alookup(question, fingerprint, question_vector)
+            if cached:
+                result = {"answer": cached["answer"], "sources": cached["sources"], "cached": True, "prompt_tokens": None}
+                return await _aremember(result, question, session_id, values)
+
+        if FETCH_PAGES:
+            with metrics.span("fetch"):
+                values = await asyncio.to_thread(enrich_results, question, values)
+    context, prompt_tokens = _prepare_context(question, webpages, values, history)
+
+    llm = llm or build_chat_model(MODEL, max_tokens=COMPLETION_TOKENS)
+    prompt, inputs = _chain_inputs(context, question, history)
+    chain_chat = LLMChain(llm=llm, prompt=prompt)
+    result = await chain_chat.acall(inputs, callbacks=callbacks)
+    output_text = result["text"]
+    if ANSWER_CACHE_ENABLED and not follow_up:
+        await get_answer_cache().aadd(question, fingerprint, output_text, sources, question_vector)
+    result = {"answer": output_text, "sources": sources, "cached": False, "prompt_tokens": prompt_tokens}
+    return await _aremember(result, question, session_id, values)
+
+
+def stream_answer(question: str, llm: BaseChatModel = None, session_id: str = None) -> Iterator[Union[str, dict]]:
+    """Yield the answer token by token as the LLM generates it, then the final {'answer', 'sources', 'cached'} payload.
+
+    `llm` must have streaming enabled; by default one is built for the call. Callers streaming the
+    same question at the same time all read from one search and LLM call.
+    """
+    if COALESCE_REQUESTS:
+        key = question_key("stream_answer", question, id(llm), session_id)
+        return SINGLE_FLIGHT.stream(key, lambda: _stream_answer(question, llm, session_id))
+    return _stream_answer(question, llm, session_id)
+
+
+def _stream_answer(question: str, llm: BaseChatModel = None, session_id: str = None) -> Iterator[Union[str, dict]]:
+    llm = llm or build_chat_model(MODEL, max_tokens=COMPLETION_TOKENS, streaming=True)
+    streamed = False
+    for item in stream_run(lambda callbacks: answer_question(question, llm=llm, callbacks=callbacks, session_id=session_id)):
+        if isinstance(item, dict):
+            # Cached and "not found" answers never reach the LLM, send them as a single chunk
+            if not streamed:
+                yield item["answer"]
+        else:
+            streamed = True
+        yield item
+
+
+def astream_answer(question: str, llm: BaseChatModel = None, session_id: str = None) -> AsyncIterator[Union[str, dict]]:
+    """Async version of stream_answer"""
+    if COALESCE_REQUESTS:
+        key = question_key("stream_answer", question, id(llm), session_id)
+        return SINGLE_FLIGHT.astream(key, lambda: _astream_answer(question, llm, session_id))
+    return _astream_answer(question, llm, session_id)
+
+
+async def _astream_answer(question: str, llm: BaseChatModel = None, session_id: str = None) -> AsyncIterator[Union[str, dict]]:
+    llm = llm or build_chat_model(MODEL, max_tokens=COMPLETION_TOKENS, streaming=True)
+    streamed = False
+    async for item in astream_run(lambda callbacks: aanswer_question(question, llm=llm, callbacks=callbacks, session_id=session_id)):
+        if isinstance(item, dict):
+            if not streamed:
+                yield item["answer"]
+        else:
+            streamed = True
+        yield item
+
+
 if __name__ == "__main__":
     question = "what is $50 in Euros?"
     ## Working Code
-    webpages = get_bing_results(question).json().get("webPages")
-    output_text = "I'm sorry, I couldn't find an answer to your question on the Leicestershire County Council website."
-    if webpages:
-        values = webpages.get("value")    
-        llm = AzureChatOpenAI(deployment_name=MODEL, temperature=0, max_tokens=COMPLETION_TOKENS)
-        chain_chat = LLMChain(llm=llm, prompt=PROMPT)
-        result = chain_chat({"results": webpages, "question": question})
-        output_text = result["text"]
-    print(output_text)
+    for item in stream_answer(question):
+        if isinstance(item, str):
+            print(item, end="", flush=True)
+    print()
     
\ No newline at end of file